@@ -0,0 +1,123 @@
+#!/usr/bin/python2.6
+"""Benchmarks comparing alternative implementations of PyCAMP filters."""
+
+import os
+import glob
+import time
+import logging
+import multiprocessing
+
+from optparse import OptionParser
+
+from camp.config import Config
+from camp.core import Image
+
+Config.ROOT_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def _load(filename, scale):
+    """Load image in the same way :class:`camp.app.Application` does and
+    optionally upscale it to emulate large scans."""
+    image = Image.load(filename)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if scale != 1:
+        image = Image(image.backend.resize(
+            (image.width * scale, image.height * scale)))
+    return image
+
+
+def _measure(func, repeat):
+    """Call ``func`` ``repeat`` times and return ``(seconds, result)`` tuple
+    with best time and result of last call."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench_quantizer(images, options):
+    """Compare palette reduction methods of Quantizer: k-means and SOM."""
+    from camp.filters.quantization import Quantizer
+    import numpy
+    config = Config.instance()
+    print "%-20s %-8s %8s %8s %8s" % ('image', 'method', 'time', 'colors', 'error')
+    for filename in images:
+        image = _load(filename, options.scale)
+        source = image.asarray().astype(numpy.float64)
+        for clusterer in ('kmeans', 'som'):
+            config.set('filters:Quantizer:clusterer', clusterer)
+            # Fast paths would skip clustering entirely
+            config.set('filters:Quantizer:passthrough_colors', '0')
+            quantizer = Quantizer()
+            elapsed, result = _measure(
+                lambda: quantizer.process(image, storage={}), options.repeat)
+            error = numpy.sqrt(((result.asarray() - source) ** 2).sum(axis=2)).mean()
+            print "%-20s %-8s %7.3fs %8d %8.2f" % (
+                os.path.basename(filename), clusterer, elapsed,
+                result.count_colors(), error)
+
+
+def bench_segmentizer(images, options):
+    """Compare whole-image, serial tiled and parallel tiled labeling of
+    Segmentizer."""
+    from camp.filters.segmentation import Segmentizer
+    config = Config.instance()
+    modes = [
+        ('whole', 0, 1),
+        ('tiled', options.tile_size, 1),
+        ('parallel', options.tile_size, options.workers)]
+    # Pool is shared by all images, so its startup is not measured
+    pool = multiprocessing.Pool(options.workers) if options.workers > 1 else None
+    print "%-20s %-8s %8s %8s %8s" % ('image', 'mode', 'time', 'speedup', 'segments')
+    try:
+        for filename in images:
+            image = _load(filename, options.scale)
+            serial = None
+            for mode, tile_size, workers in modes:
+                config.set('filters:Segmentizer:tile_size', str(tile_size))
+                config.set('filters:Segmentizer:workers', str(workers))
+                segmentizer = Segmentizer(pool=pool if workers > 1 else None)
+                storage = {}
+                elapsed, _ = _measure(
+                    lambda: segmentizer.process(image, storage=storage), options.repeat)
+                if serial is None:
+                    serial = elapsed
+                print "%-20s %-8s %7.3fs %7.2fx %8d" % (
+                    os.path.basename(filename), mode, elapsed, serial / elapsed,
+                    len(storage['Segmentizer']['segments']))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+parser = OptionParser(usage='Usage: %prog [options] quantizer|segmentizer [image ...]')
+parser.add_option('-c', '--config', dest='config',
+    help='path to config file to be used', metavar='PATH')
+parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+    help='number of repetitions; best time is reported (default: 3)')
+parser.add_option('-s', '--scale', dest='scale', type='int', default=1,
+    help='upscale input images by given integer factor (default: 1)')
+parser.add_option('-t', '--tile-size', dest='tile_size', type='int', default=512,
+    help='tile size used by segmentizer benchmark (default: 512)')
+parser.add_option('-w', '--workers', dest='workers', type='int',
+    default=multiprocessing.cpu_count(),
+    help='number of processes used by segmentizer benchmark (default: number of CPUs)')
+
+benchmarks = {
+    'quantizer': bench_quantizer,
+    'segmentizer': bench_segmentizer}
+
+options, args = parser.parse_args()
+if not args or args[0] not in benchmarks:
+    parser.error('expecting one of: %s' % ', '.join(sorted(benchmarks)))
+
+logging.basicConfig(level=logging.WARNING)
+Config.instance(config=options.config, argv={
+    'infile': '', 'outfile': '', 'timeit': False, 'dump': False, 'cbounds': None})
+images = args[1:] or sorted(glob.glob(os.path.join(Config.ROOT_DIR, 'samples', 'ex*.png')))
+benchmarks[args[0]](images, options)
@@ -59,7 +59,7 @@ class Application(object):
         """Execute application and return exit code."""
         # Load source image
         source = Image.load(self.infile)
-        if source.mode != 'RGB':
+        if source.mode not in ('RGB', 'P'):
             source = source.convert('RGB')
         
         # Create filter stack
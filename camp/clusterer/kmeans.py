@@ -1,7 +1,9 @@
 import random
 
+import numpy
+
 from camp.util import Random
-from camp.clusterer.metric import euclidean2
+from camp.clusterer.metric import euclidean, euclidean2, hsvmetric, pairwise, paired, nearest
 
 
 class Cluster(object):
@@ -98,22 +100,40 @@ class Cluster(object):
             (self.__class__.__name__, self.centroid, len(self.samples))
 
 
-def kmeans(samples, clusters, max_epochs=10):
-    """Split samples into k-clusters using provided initial list of
-    clusters.
-    
-    :param samples: array of sample vectors having same size
-    :param clusters: array containing k-clusters
-    :param max_epochs: specifies maximal number of training epochs. One
-        training epoch is exactly one iteration over ``clusters`` array"""
+def _check_clusters(clusters):
+    """Check if ``clusters`` argument of k-means functions is valid."""
     if not isinstance(clusters, list) or len(clusters) == 0:
         raise TypeError("clusters: list of Cluster instances expected, found %s" % type(clusters))
     dim = clusters[0].dim
     for i, c in enumerate(clusters[1:]):
         if c.dim != dim:
             raise ValueError("clusters[%d]: dimensions differ: %d != %d" % (i+1, c.dim, dim))
+
+
+def _report(stats, epochs, distances, skipped=0):
+    """Fill ``stats`` dictionary given to k-means functions."""
+    if stats is None:
+        return
+    stats['epochs'] = epochs
+    stats['distances'] = distances
+    stats['skipped'] = skipped
+
+
+def kmeans(samples, clusters, max_epochs=10, stats=None):
+    """Split samples into k-clusters using provided initial list of
+    clusters.
+    
+    :param samples: array of sample vectors having same size
+    :param clusters: array containing k-clusters
+    :param max_epochs: specifies maximal number of training epochs. One
+        training epoch is exactly one iteration over ``clusters`` array
+    :param stats: optional dictionary that will be filled with number of
+        ``epochs`` performed, number of sample-centroid ``distances``
+        calculated and number of distance calculations ``skipped``"""
+    _check_clusters(clusters)
     clusters = set(clusters)
     for epoch in xrange(max_epochs):
+        _report(stats, epoch + 1, (epoch + 1) * len(samples) * len(clusters))
         # Assign each sample to the nearest cluster
         for sample in samples:
             min(clusters, key=lambda x: x.distance(sample)).add(sample)
@@ -128,3 +148,273 @@ def kmeans(samples, clusters, max_epochs=10):
                 i += 1
         if i == len(clusters):
             return clusters
+
+
+def _sums(labels, samples, k, weights=None):
+    """Return ``(counts, sums)`` tuple of arrays containing number (or total
+    weight) of samples and (weighted) sum of sample vectors for each of ``k``
+    clusters."""
+    counts = numpy.bincount(labels, weights=weights, minlength=k).astype(numpy.float64)
+    sums = numpy.empty((k, samples.shape[1]), dtype=numpy.float64)
+    for i in xrange(samples.shape[1]):
+        values = samples[:, i] if weights is None else samples[:, i] * weights
+        sums[:, i] = numpy.bincount(labels, weights=values, minlength=k)
+    return counts, sums
+
+
+def _finish(clusters, samples, centroids, labels):
+    """Write final centroids and sample assignment back to ``clusters``
+    list and return set of clusters, as :func:`kmeans` does."""
+    order = numpy.argsort(labels, kind='mergesort')
+    bounds = numpy.searchsorted(labels[order], numpy.arange(len(clusters) + 1))
+    for i, c in enumerate(clusters):
+        c.centroid = tuple(centroids[i].tolist())
+        c.samples = set([tuple(samples[j]) for j in order[bounds[i]:bounds[i+1]]])
+        c._acc = [0 for _ in xrange(c.dim)]
+    return set(clusters)
+
+
+def _weights(weights, n):
+    """Validate and return ``weights`` argument of k-means functions as an
+    array (or ``None`` if not given)."""
+    if weights is None:
+        return
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    if weights.shape != (n,):
+        raise ValueError("weights: expecting exactly %d elements, found %d" % (n, weights.size))
+    return weights
+
+
+def _check_metrics(clusters):
+    """Check if all clusters use same metric, as array based k-means
+    functions calculate distances to all centroids at once, and return that
+    metric."""
+    metric = clusters[0].metric
+    for i, c in enumerate(clusters):
+        if c.metric is not metric:
+            raise ValueError("clusters[%d]: metric differs: %s != %s" % (i, c.metric, metric))
+    return metric
+
+
+def _prepare(samples, clusters, weights):
+    """Return ``(samples, data, weights, centroids)`` tuple for array based
+    k-means functions, where ``samples`` is a list of samples, ``data`` and
+    ``centroids`` are arrays of samples and initial centroids and ``weights``
+    is an array or ``None``."""
+    if not isinstance(samples, list):
+        samples = numpy.asarray(samples).tolist()
+    data = numpy.asarray(samples, dtype=numpy.float64).reshape(-1, clusters[0].dim)
+    weights = _weights(weights, data.shape[0])
+    centroids = numpy.array([c.centroid for c in clusters], dtype=numpy.float64)
+    return samples, data, weights, centroids
+
+
+def _update(centroids, labels, data, weights):
+    """Return new centroids, calculated as means of assigned samples.
+    Centroids of empty clusters are not changed."""
+    counts, sums = _sums(labels, data, centroids.shape[0], weights=weights)
+    updated = centroids.copy()
+    nonempty = counts > 0
+    updated[nonempty] = sums[nonempty] / counts[nonempty, numpy.newaxis]
+    return updated
+
+
+def kmeans_numpy(samples, clusters, max_epochs=10, weights=None, stats=None):
+    """Array based version of :func:`kmeans`. Takes same arguments, but in
+    each epoch distances between all samples and all centroids are
+    calculated as a matrix (using array kernel of clusters' metric) and
+    clusters only track number and sum of assigned samples. Sets of samples
+    are filled once, after last epoch. All clusters must use same metric.
+    
+    Results are same as results of :func:`kmeans` as long as centroids of
+    all clusters move in each epoch. Otherwise they may differ, as
+    :meth:`Cluster.update` used by :func:`kmeans` keeps samples of clusters
+    which centroid did not move, while this function always calculates
+    centroids as plain means of samples assigned in current epoch.
+    
+    :param weights: optional sequence of sample weights (f.e. number of
+        pixels having color given as sample). Centroids are calculated as
+        weighted means of assigned samples"""
+    _check_clusters(clusters)
+    metric = _check_metrics(clusters)
+    samples, data, weights, centroids = _prepare(samples, clusters, weights)
+    for epoch in xrange(max_epochs):
+        _report(stats, epoch + 1, (epoch + 1) * data.shape[0] * len(clusters))
+        # Assign each sample to the nearest cluster
+        labels = nearest(metric, data, centroids)
+        # Check if maximal number of epochs has been reached
+        if epoch == max_epochs - 1:
+            break
+        # Move centroids of non-empty clusters to mean of assigned samples.
+        # Stop if no centroid was changed
+        updated = _update(centroids, labels, data, weights)
+        if (updated == centroids).all():
+            break
+        centroids = updated
+    return _finish(clusters, samples, centroids, labels)
+
+
+# Metrics that satisfy triangle inequality, used by :func:`kmeans_hamerly`
+# instead of metric given to clusters. Squared euclidean distance gives same
+# assignment as euclidean distance, but is not a metric in strict sense
+_true_metrics = {euclidean2: euclidean, euclidean: euclidean, hsvmetric: hsvmetric}
+
+
+def _distances(metric, samples, centroids, chunk=1024):
+    """Return matrix of distances between each sample and each centroid,
+    calculated for ``chunk`` samples at once."""
+    result = numpy.empty((samples.shape[0], centroids.shape[0]), dtype=numpy.float64)
+    for start in xrange(0, samples.shape[0], chunk):
+        result[start:start+chunk] = pairwise(metric, samples[start:start+chunk], centroids)
+    return result
+
+
+def _two_nearest(metric, samples, centroids):
+    """Return ``(labels, upper, lower)`` tuple of arrays containing index of
+    nearest centroid, distance to nearest centroid and distance to second
+    nearest centroid of each sample."""
+    d = _distances(metric, samples, centroids)
+    rows = numpy.arange(samples.shape[0])
+    labels = d.argmin(axis=1)
+    upper = d[rows, labels]
+    if centroids.shape[0] == 1:
+        return labels, upper, numpy.repeat(numpy.inf, upper.size)
+    d[rows, labels] = numpy.inf
+    return labels, upper, d.min(axis=1)
+
+
+def kmeans_hamerly(samples, clusters, max_epochs=10, weights=None, stats=None):
+    """Version of :func:`kmeans_numpy` accelerated with Hamerly's algorithm.
+    For each sample upper bound of distance to its centroid and lower bound
+    of distance to any other centroid is maintained. Once centroids move,
+    bounds are only adjusted by distances the centroids moved and distances
+    are recalculated only for samples which bounds do not guarantee that the
+    assignment stays the same. Gives same result as :func:`kmeans_numpy` and
+    takes same arguments. Number of distance calculations skipped is
+    reported in ``stats``. Clusters' metric must satisfy triangle inequality
+    (squared euclidean distance is replaced with euclidean distance)."""
+    _check_clusters(clusters)
+    metric = _check_metrics(clusters)
+    if metric not in _true_metrics:
+        raise ValueError("metric not supported: %s" % metric)
+    metric = _true_metrics[metric]
+    samples, data, weights, centroids = _prepare(samples, clusters, weights)
+    n, k = data.shape[0], centroids.shape[0]
+    labels, upper, lower = _two_nearest(metric, data, centroids)
+    computed = n * k
+    for epoch in xrange(max_epochs):
+        _report(stats, epoch + 1, computed, (epoch + 1) * n * k - computed)
+        # Check if maximal number of epochs has been reached
+        if epoch == max_epochs - 1:
+            break
+        # Move centroids and stop if no centroid was changed
+        updated = _update(centroids, labels, data, weights)
+        if (updated == centroids).all():
+            break
+        moved = paired(metric, updated, centroids)
+        centroids = updated
+        # Adjust bounds: distance to own centroid can grow by at most the
+        # distance that centroid moved, distance to other centroids can shrink
+        # by at most the largest distance other centroid moved
+        order = numpy.argsort(moved)
+        upper += moved[labels]
+        if k > 1:
+            lower -= numpy.where(labels == order[-1], moved[order[-2]], moved[order[-1]])
+        # Half of distance from each centroid to nearest other centroid.
+        # Samples closer than that to its centroid cannot change assignment
+        if k > 1:
+            between = _distances(metric, centroids, centroids)
+            between[numpy.arange(k), numpy.arange(k)] = numpy.inf
+            half = between.min(axis=1) / 2.0
+        else:
+            half = numpy.repeat(numpy.inf, k)
+        bound = numpy.maximum(half[labels], lower)
+        # Tighten upper bounds of samples that might change the assignment
+        # and check again
+        candidates = numpy.flatnonzero(upper > bound)
+        if candidates.size:
+            upper[candidates] = paired(metric, data[candidates], centroids[labels[candidates]])
+            computed += candidates.size
+            candidates = candidates[upper[candidates] > bound[candidates]]
+        # Find nearest centroids for remaining samples
+        if candidates.size:
+            labels[candidates], upper[candidates], lower[candidates] =\
+                _two_nearest(metric, data[candidates], centroids)
+            computed += candidates.size * k
+    return _finish(clusters, samples, centroids, labels)
+
+
+def minibatches(samples, size, weights=None, seed=0):
+    """Generator of ``(samples, weights)`` batches for
+    :func:`kmeans_minibatch`. Each batch contains ``size`` samples drawn at
+    random from ``samples``. Samples are drawn without repetition until all
+    of them are used and then next pass over samples begins, in different
+    order. The generator never stops (unless there are no samples).
+    
+    :param samples: sequence of samples
+    :param size: number of samples in single batch
+    :param weights: optional sequence of sample weights
+    :param seed: seed of random number generator used to shuffle samples"""
+    data = numpy.asarray(samples, dtype=numpy.float64)
+    weights = _weights(weights, data.shape[0])
+    if not data.shape[0]:
+        return
+    rnd = numpy.random.RandomState(seed)
+    while True:
+        order = rnd.permutation(data.shape[0])
+        for start in xrange(0, order.size, size):
+            batch = order[start:start+size]
+            yield data[batch], None if weights is None else weights[batch]
+
+
+def kmeans_minibatch(batches, clusters, max_batches=100, tol=1e-2, stats=None):
+    """Mini-batch version of k-means. Instead of iterating over entire
+    training set in each epoch, centroids are updated after each batch of
+    samples taken from ``batches`` iterable (see :func:`minibatches`), with
+    learning rate decreasing with number of samples already assigned to
+    cluster. Stops once no centroid moves more than ``tol`` after a batch or
+    once ``max_batches`` batches are processed, so time is bounded by batch
+    size and number of batches, not by number of samples. Returns set of
+    clusters, as :func:`kmeans` does, but sets of samples are left empty.
+    
+    :param batches: iterable of ``(samples, weights)`` tuples, where
+        ``samples`` is array of samples and ``weights`` is array of sample
+        weights or ``None``
+    :param clusters: array containing k-clusters
+    :param max_batches: maximal number of batches to be processed
+    :param tol: maximal (euclidean) distance between old and new centroid
+        of each cluster below which centroids are treated as converged
+    :param stats: see :func:`kmeans` (each batch is counted as an epoch)"""
+    _check_clusters(clusters)
+    metric = _check_metrics(clusters)
+    dim, k = clusters[0].dim, len(clusters)
+    centroids = numpy.array([c.centroid for c in clusters], dtype=numpy.float64)
+    totals = numpy.zeros(k, dtype=numpy.float64)
+    nbatches = distances = 0
+    _report(stats, nbatches, distances)
+    for samples, weights in batches:
+        if nbatches == max_batches:
+            break
+        data = numpy.asarray(samples, dtype=numpy.float64).reshape(-1, dim)
+        weights = _weights(weights, data.shape[0])
+        labels = nearest(metric, data, centroids)
+        nbatches += 1
+        distances += data.shape[0] * k
+        _report(stats, nbatches, distances)
+        # Move each centroid towards mean of samples assigned in this batch.
+        # Learning rate is inverse of total weight assigned to cluster so far
+        counts, sums = _sums(labels, data, k, weights=weights)
+        totals += counts
+        nonempty = counts > 0
+        updated = centroids.copy()
+        updated[nonempty] += (sums[nonempty] - counts[nonempty, numpy.newaxis] *
+            centroids[nonempty]) / totals[nonempty, numpy.newaxis]
+        shift = numpy.sqrt(((updated - centroids) ** 2).sum(axis=1)).max()
+        centroids = updated
+        if shift <= tol:
+            break
+    for i, c in enumerate(clusters):
+        c.centroid = tuple(centroids[i].tolist())
+        c.samples = set()
+        c._acc = [0 for _ in xrange(c.dim)]
+    return set(clusters)
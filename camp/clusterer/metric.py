@@ -1,9 +1,17 @@
 """Definition of metric functions. Each metric function takes two arguments:
 sequences representing two vectors of same dimensions. Metric functions are
 used to measure similarity of given vectors (distance from one to another). The
-lower return value is, the more similar vectors are."""
+lower return value is, the more similar vectors are.
+
+Each metric function has its array kernel (``*_pairwise`` function) that
+calculates matrix of distances between each vector of one array and each
+vector of another array at once. Scalar metric functions are reference
+implementations for the kernels. Use :func:`pairwise`, :func:`paired`,
+:func:`one_to_many` and :func:`nearest` to call kernel matching given scalar metric function."""
 import math
 
+import numpy
+
 
 def euclidean2(a, b):
     """Calculates squared Euclidean distance between given two vectors."""
@@ -15,19 +23,117 @@ def euclidean(a, b):
     return math.sqrt(euclidean2(a, b))
 
 
+def _deg2rad(x):
+    return math.pi * 2.0 * x / 360.0
+
+
+def _hue2val(h):
+    return (1.0 - (math.cos(_deg2rad(h)) + 1.0) / 2.0)
+
+
+def _threshold(v):
+    return 1.0 - 0.8*v
+
+
 def hsvmetric(a, b):
     """Calculates distance between given two HSV colors."""
-    def deg2rad(x):
-        return math.pi * 2.0 * x / 360.0
-    def hue2val(h):
-        return (1.0 - (math.cos(deg2rad(h)) + 1.0) / 2.0)
-    def threshold(v):
-        return 1.0 - 0.8*v
     h1, s1, v1 = a[0], a[1]/100.0, a[2]/100.0
-    p = (0, hue2val(h1)) if s1 > threshold(v1) else (1, v1)
+    p = (0, _hue2val(h1)) if s1 > _threshold(v1) else (1, v1)
     h2, s2, v2 = b[0], b[1]/100.0, b[2]/100.0
-    q = (0, hue2val(h2)) if s2 > threshold(v2) else (1, v2)
+    q = (0, _hue2val(h2)) if s2 > _threshold(v2) else (1, v2)
     #if p[0] == q[0]:
     #    return abs(p[1]-q[1])
     #else:
-    return euclidean((hue2val(h1), s1, v1), (hue2val(h2), s2, v2))
+    return euclidean((_hue2val(h1), s1, v1), (_hue2val(h2), s2, v2))
+
+
+### Array kernels
+
+def euclidean2_pairwise(a, b):
+    """Array kernel of :func:`euclidean2`.
+    
+    :param a: array of vectors of shape ``(n, dim)``
+    :param b: array of vectors of shape ``(m, dim)``
+    :rtype: array of shape ``(n, m)``"""
+    a = numpy.asarray(a, dtype=numpy.float64)
+    b = numpy.asarray(b, dtype=numpy.float64)
+    return ((a[:, numpy.newaxis, :] - b[numpy.newaxis, :, :]) ** 2).sum(axis=2)
+
+
+def euclidean_pairwise(a, b):
+    """Array kernel of :func:`euclidean`. See :func:`euclidean2_pairwise`."""
+    return numpy.sqrt(euclidean2_pairwise(a, b))
+
+
+def _hsv_features(a):
+    """Convert array of HSV colors into vectors compared by
+    :func:`hsvmetric`."""
+    a = numpy.asarray(a, dtype=numpy.float64)
+    h = 1.0 - (numpy.cos(math.pi * 2.0 * a[:, 0] / 360.0) + 1.0) / 2.0
+    return numpy.column_stack((h, a[:, 1] / 100.0, a[:, 2] / 100.0))
+
+
+def hsvmetric_pairwise(a, b):
+    """Array kernel of :func:`hsvmetric`. See :func:`euclidean2_pairwise`."""
+    return euclidean_pairwise(_hsv_features(a), _hsv_features(b))
+
+
+_kernels = {
+    euclidean2: euclidean2_pairwise,
+    euclidean: euclidean_pairwise,
+    hsvmetric: hsvmetric_pairwise}
+
+
+def pairwise(metric, a, b):
+    """Calculate matrix of distances between each vector of ``a`` and each
+    vector of ``b`` using array kernel of given metric function. Metrics
+    without kernel are evaluated for each pair of vectors.
+    
+    :param metric: scalar metric function
+    :param a: array of vectors of shape ``(n, dim)``
+    :param b: array of vectors of shape ``(m, dim)``"""
+    kernel = _kernels.get(metric)
+    if kernel:
+        return kernel(a, b)
+    a = numpy.asarray(a, dtype=numpy.float64).tolist()
+    b = numpy.asarray(b, dtype=numpy.float64).tolist()
+    return numpy.array([[metric(x, y) for y in b] for x in a], dtype=numpy.float64).reshape(len(a), len(b))
+
+
+def paired(metric, a, b):
+    """Calculate distances between each pair of vectors ``a[i]`` and
+    ``b[i]``. Both arrays must have same shape. See :func:`pairwise`."""
+    a = numpy.asarray(a, dtype=numpy.float64)
+    b = numpy.asarray(b, dtype=numpy.float64)
+    if metric is hsvmetric:
+        a, b, metric = _hsv_features(a), _hsv_features(b), euclidean
+    if metric in (euclidean, euclidean2):
+        result = ((a - b) ** 2).sum(axis=1)
+        return numpy.sqrt(result) if metric is euclidean else result
+    return numpy.array([metric(x, y) for x, y in zip(a.tolist(), b.tolist())], dtype=numpy.float64)
+
+
+def one_to_many(metric, a, b):
+    """Calculate distances between vector ``a`` and each vector of ``b``.
+    See :func:`pairwise`."""
+    return pairwise(metric, [a], b)[0]
+
+
+def nearest(metric, a, b, chunk=4096):
+    """Return array containing index of nearest vector from ``b`` for each
+    vector of ``a``. Distances are calculated for ``chunk`` vectors of ``a``
+    at once. See :func:`pairwise`."""
+    a = numpy.asarray(a, dtype=numpy.float64)
+    b = numpy.asarray(b, dtype=numpy.float64)
+    result = numpy.empty(a.shape[0], dtype=numpy.intp)
+    if metric in (euclidean, euclidean2):
+        # Squared distance without squared norm of vectors from ``a``, which
+        # is constant for each row and does not change the result
+        b2 = (b ** 2).sum(axis=1)
+        for start in xrange(0, a.shape[0], chunk):
+            d = b2 - 2.0 * numpy.dot(a[start:start+chunk], b.T)
+            result[start:start+chunk] = d.argmin(axis=1)
+    else:
+        for start in xrange(0, a.shape[0], chunk):
+            result[start:start+chunk] = pairwise(metric, a[start:start+chunk], b).argmin(axis=1)
+    return result
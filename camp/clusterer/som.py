@@ -1,9 +1,11 @@
 import math
 import random
 
+import numpy
+
 from PIL import Image, ImageDraw
 from camp.util import Random
-from camp.clusterer.metric import euclidean2
+from camp.clusterer.metric import euclidean2, nearest
 
 
 class _Node(object):
@@ -52,6 +54,12 @@ class BaseTopology(object):
         :param radius: radius of neighbourhood that will be generated"""
         raise NotImplementedError()
 
+    def distances(self):
+        """Return matrix of distances (measured according to neighbourhood
+        used) between each two nodes. This is used to calculate neighbourhood
+        of all nodes at once."""
+        raise NotImplementedError()
+
     def bounding_boxes(self, width=20, height=20):
         """Generator of neighbourhood's nodes bounding boxes. This method is
         used to visualize SOM grid. Each generated value is a 5 element tuple
@@ -93,6 +101,13 @@ class RectangularTopology(BaseTopology):
             for c in xrange(colstart, colend+1):
                 yield r * cols + c, max(abs(r-row), abs(c-col))
 
+    def distances(self):
+        index = numpy.arange(self.rows * self.cols)
+        rows, cols = index // self.cols, index % self.cols
+        return numpy.maximum(
+            numpy.abs(rows[:, numpy.newaxis] - rows[numpy.newaxis, :]),
+            numpy.abs(cols[:, numpy.newaxis] - cols[numpy.newaxis, :]))
+
     def bounding_boxes(self, width=20, height=20):
         for n in self.nodes:
             x = n.index % self.cols
@@ -192,6 +207,48 @@ class Som(object):
                     for i in xrange(len(w)):
                         w[i] += factor * (sample[i]-w[i])
     
+    def train_batch(self, samples, epochs, weights=None):
+        """Batch version of :meth:`train`. In each epoch best matching units
+        of all samples are found at once and then weight of each node is set
+        to mean of all samples weighted by neighbourhood kernel of their
+        BMUs, so learning rate is not used. Neighbourhood radius decreases
+        during learning process in the same way as in :meth:`train`.
+        
+        :param samples: sequence of training vectors
+        :param epochs: number of training epochs
+        :param weights: optional sequence of sample weights"""
+        nodes = self.topology.nodes
+        data = numpy.asarray(samples, dtype=numpy.float64)
+        if weights is not None:
+            weights = numpy.asarray(weights, dtype=numpy.float64)
+        grid = self.topology.distances()
+        max_radius = max(max(self.topology.rows, self.topology.cols) / 2, 1)
+        for e in xrange(epochs):
+            # Calculate current neighbourhood radius
+            radius = max_radius * math.exp(-e/(epochs/math.log(self.radius_modifier*max_radius)))
+            # Find BMU of each sample and sum samples matching each node
+            bmus = self.bmus(data)
+            counts = numpy.bincount(bmus, weights=weights, minlength=len(nodes))
+            sums = numpy.empty((len(nodes), data.shape[1]), dtype=numpy.float64)
+            for i in xrange(data.shape[1]):
+                values = data[:, i] if weights is None else data[:, i] * weights
+                sums[:, i] = numpy.bincount(bmus, weights=values, minlength=len(nodes))
+            # Calculate new weights as kernel weighted mean of samples. Nodes
+            # with no samples in their neighbourhood are not changed
+            kernel = numpy.exp(-(grid ** 2) / float(radius ** 2)) * (grid <= radius)
+            total = numpy.dot(kernel, counts)
+            updated = numpy.dot(kernel, sums)
+            for i in numpy.flatnonzero(total > 0):
+                nodes[i].weight = (updated[i] / total[i]).tolist()
+
+    def bmus(self, samples):
+        """Return array of indices of best matching units for all given
+        samples.
+        
+        :param samples: sequence of sample vectors"""
+        weights = numpy.array([n.weight for n in self.topology.nodes], dtype=numpy.float64)
+        return nearest(self.metric, samples, weights)
+
     def bmu(self, sample):
         """Find and return best matching unit (BMU) node instance for given
         ``sample`` vector.
@@ -124,6 +124,15 @@ class Config(object):
         else:
             return ScalarProxy(result)
 
+    def set(self, path, value):
+        """Set value of config entry matching ``path``, overriding value read
+        from config file.
+        
+        :param path: config entry path, f.e. ``foo:bar:baz``
+        :param value: new value"""
+        section, option = path.rsplit(':', 1)
+        self._config.setdefault(section, {})[option] = value
+
     def save(self, path):
         """Write config to given config file."""
         fd = open(path, 'wb')
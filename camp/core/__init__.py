@@ -1,11 +1,42 @@
 """Core classes & functions."""
 
+import numpy
+
 from hashlib import md5
 
 from PIL import Image as PILImage, ImageDraw, ImageChops as PILImageChops
 from PIL import ImageStat as PILImageStat
 
 
+def pack(array):
+    """Pack channels of given array (last axis) into single ``uint32`` number
+    per pixel, f.e. ``(r, g, b)`` becomes ``r << 16 | g << 8 | b``. Packed
+    colors can be compared, sorted and used as array indices much faster than
+    color tuples.
+    
+    :param array: array of shape ``(..., nchannels)`` with at most 4 channels
+        of 8-bit values"""
+    array = numpy.asarray(array)
+    result = numpy.zeros(array.shape[:-1], dtype=numpy.uint32)
+    for i in xrange(array.shape[-1]):
+        result <<= 8
+        result |= array[..., i]
+    return result
+
+
+def unpack(array, nchannels=3):
+    """Reverse of :func:`pack`. Return ``uint8`` array of shape ``(...,
+    nchannels)``.
+    
+    :param array: array of packed colors
+    :param nchannels: number of channels packed in each value"""
+    array = numpy.asarray(array, dtype=numpy.uint32)
+    result = numpy.empty(array.shape + (nchannels,), dtype=numpy.uint8)
+    for i in xrange(nchannels):
+        result[..., nchannels-i-1] = (array >> (8 * i)) & 0xff
+    return result
+
+
 class Image(object):
     """Proxy class for underlying PIL's Image class."""
     
@@ -65,6 +96,15 @@ class Image(object):
         can be accessed on resulting object by getting ``(x,y)`` key on it."""
         return self.backend.load()
 
+    @property
+    def palette(self):
+        """Return list of ``(r, g, b)`` palette colors for palette (``P``)
+        images or ``None`` for images of other modes."""
+        if self.mode != 'P':
+            return
+        palette = self.backend.getpalette()
+        return [tuple(palette[i:i+3]) for i in xrange(0, len(palette), 3)]
+
     @property
     def draw(self):
         """Return reference to PIL's ImageDraw class intance allowing to draw
@@ -72,6 +112,14 @@ class Image(object):
         return ImageDraw.Draw(self.backend)
 
     ### Public methods
+
+    def asarray(self):
+        """Return pixels of this image as read-only numpy array of shape
+        ``(height, width)`` for single channel images or ``(height, width,
+        nchannels)`` for multichannel ones. The array is created by single
+        copy of image data, so it should be used instead of :attr:`pixels`
+        whenever entire image needs to be processed."""
+        return numpy.asarray(self.backend)
     
     def colors(self, encoder=None):
         """Return list of ``(amount, color)`` tuples each representing number
@@ -87,6 +135,16 @@ class Image(object):
             for n, c in self.backend.getcolors(self.width * self.height):
                 yield n, encoder(c)
     
+    def count_colors(self, limit=None):
+        """Return number of distinct colors in the image or ``None`` if the
+        image has more than ``limit`` colors. Counting stops as soon as limit
+        is exceeded.
+        
+        :param limit: maximal number of colors to be counted"""
+        colors = self.backend.getcolors(limit or self.npixels)
+        if colors is not None:
+            return len(colors)
+
     def convert(self, mode, matrix=None):
         """Convert this image to different mode and return converted image.
         
@@ -119,8 +177,12 @@ class Image(object):
         return Image(self.backend.rotate(angle))
 
     def checksum(self):
-        """Create and return md5 checksum of this image."""
-        return md5(self.backend.tostring()).hexdigest()
+        """Create and return md5 checksum of this image. Checksum of palette
+        (``P``) images covers both pixel data and the palette."""
+        result = md5(self.backend.tostring())
+        if self.mode == 'P':
+            result.update(str(bytearray(self.backend.getpalette())))
+        return result.hexdigest()
 
     def show(self):
         """Show image using system viewer. Debugging purposes only."""
@@ -128,16 +190,22 @@ class Image(object):
 
     def colormask(self, colors):
         """Create mask that masks given set of colors in the image."""
-        colors = set(colors)
-        dest = Image.create('1', self.width, self.height)
-        sp, dp = self.pixels, dest.pixels
-        for x in xrange(self.width):
-            for y in xrange(self.height):
-                if sp[x, y] in colors:
-                    dp[x, y] = 1
-                else:
-                    dp[x, y] = 0
-        return dest
+        source = self.asarray()
+        colors = numpy.array(list(set(colors)), dtype=numpy.uint32)
+        if source.ndim == 3:
+            source = pack(source)
+            colors = pack(colors.reshape(-1, self.nchannels))
+        return Image.fromarray(numpy.in1d(source, colors).reshape(source.shape))
+
+    def fill(self, color, mask=None):
+        """Fill this image (or part of it selected by ``mask``) with given
+        color. This function affects current image.
+        
+        :param color: fill color
+        :param mask: optional mask image of mode ``1`` or ``L`` having same
+            size as this image"""
+        self.backend.paste(color, None, mask.backend if mask else None)
+        return self
 
     def copy(self):
         """Return new Image that is a copy of current one."""
@@ -177,6 +245,17 @@ class Image(object):
         else:
             return Image(PILImage.new(mode, (width, height)))
 
+    @classmethod
+    def fromarray(cls, array, mode=None):
+        """Create image from numpy array and return new instance of Image
+        class. This is reverse of :meth:`asarray`.
+        
+        :param array: array of shape ``(height, width)`` or ``(height, width,
+            nchannels)``
+        :param mode: optional mode of resulting image. If not given, mode is
+            determined from array's shape and type"""
+        return Image(PILImage.fromarray(numpy.ascontiguousarray(array), mode))
+
     @classmethod
     def load(cls, filename):
         """Load image from given file and return instance of Image class.
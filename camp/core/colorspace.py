@@ -1,5 +1,27 @@
 # -*- coding: utf-8 -*-
+import os
 import math
+import logging
+
+import numpy
+
+from camp.core import pack, unpack
+
+log = logging.getLogger(__name__)
+
+
+def _round(array):
+    """Round array items half away from zero (same as builtin ``round``) and
+    return array of integers."""
+    a = numpy.abs(array)
+    f = numpy.floor(a)
+    return numpy.copysign(f + (a - f >= 0.5), array).astype(numpy.int_)
+
+
+def _stack(*channels):
+    """Join given channel arrays into single array of shape ``(...,
+    nchannels)``."""
+    return numpy.concatenate([c[..., numpy.newaxis] for c in channels], axis=-1)
 
 
 class Range(object):
@@ -11,7 +33,11 @@ class Range(object):
 class Convert(object):
     """Set of functions to convert from one colorspace to another.
     :meth:`rgb2lab` and :meth:`lab2rgb` thanks to the following article:
-    http://cookbooks.adobe.com/post_Useful_color_equations__RGB_to_LAB_converter-14227.html"""
+    http://cookbooks.adobe.com/post_Useful_color_equations__RGB_to_LAB_converter-14227.html
+    
+    Each conversion function has its ``*_array`` variant, that converts entire
+    array of shape ``(..., 3)`` in single call giving same results as the
+    scalar version would give for each color separately."""
 
     @classmethod
     def rgb2xyz(cls, rgb):
@@ -221,3 +247,231 @@ class Convert(object):
             else:  # i == 5.0:
                 r, g, b = v, p, q
             return int(r*255.0), int(g*255.0), int(b*255.0)
+
+    ### Array variants
+
+    @classmethod
+    def rgb2xyz_array(cls, rgb):
+        """Array variant of :meth:`rgb2xyz`.
+        
+        :param rgb: array of RGB colors"""
+        c = numpy.asarray(rgb, dtype=numpy.float64) / 255.0
+        c = numpy.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+        c = c * 100.0
+        r, g, b = c[..., 0], c[..., 1], c[..., 2]
+
+        # Observer = 2°, Illuminant = D65
+        x = r * 0.4124 + g * 0.3576 + b * 0.1805
+        y = r * 0.2126 + g * 0.7152 + b * 0.0722
+        z = r * 0.0193 + g * 0.1192 + b * 0.9505
+
+        return _stack(x, y, z)
+
+    @classmethod
+    def xyz2lab_array(cls, xyz):
+        """Array variant of :meth:`xyz2lab`.
+        
+        :param xyz: array of XYZ colors"""
+        xyz = numpy.asarray(xyz, dtype=numpy.float64)
+        # Observer = 2°, Illuminant = D65
+        c = _stack(xyz[..., 0] / 95.047, xyz[..., 1] / 100.0, xyz[..., 2] / 108.883)
+        with numpy.errstate(invalid='ignore'):
+            c = numpy.where(c > 0.008856, c ** (1.0 / 3.0), (7.787 * c) + (16.0 / 116.0))
+        x, y, z = c[..., 0], c[..., 1], c[..., 2]
+
+        l = ( 116.0 * y ) - 16.0
+        a = 500.0 * ( x - y )
+        b = 200.0 * ( y - z )
+
+        return _stack(l, a, b)
+
+    @classmethod
+    def rgb2lab_array(cls, rgb):
+        """Array variant of :meth:`rgb2lab`.
+        
+        :param rgb: array of RGB colors"""
+        return cls.xyz2lab_array(cls.rgb2xyz_array(rgb))
+
+    @classmethod
+    def lab2xyz_array(cls, lab):
+        """Array variant of :meth:`lab2xyz`.
+        
+        :param lab: array of Lab colors"""
+        lab = numpy.asarray(lab, dtype=numpy.float64)
+        y = (lab[..., 0] + 16.0) / 116.0
+        x = lab[..., 1] / 500.0 + y
+        z = y - lab[..., 2] / 200.0
+        c = _stack(x, y, z)
+        c = numpy.where(c ** 3 > 0.008856, c ** 3, (c - 16.0 / 116.0) / 7.787)
+
+        return _stack(95.047 * c[..., 0], 100.0 * c[..., 1], 108.883 * c[..., 2])
+
+    @classmethod
+    def xyz2rgb_array(cls, xyz):
+        """Array variant of :meth:`xyz2rgb`.
+
+        :param xyz: array of XYZ colors"""
+        xyz = numpy.asarray(xyz, dtype=numpy.float64)
+        x = xyz[..., 0] / 100.0
+        y = xyz[..., 1] / 100.0
+        z = xyz[..., 2] / 100.0
+
+        r = x * 3.2406 + y * -1.5372 + z * -0.4986
+        g = x * -0.9689 + y * 1.8758 + z * 0.0415
+        b = x * 0.0557 + y * -0.2040 + z * 1.0570
+
+        c = _stack(r, g, b)
+        with numpy.errstate(invalid='ignore'):
+            c = numpy.where(c > 0.0031308, 1.055 * (c ** (1.0 / 2.4)) - 0.055, 12.92 * c)
+
+        return _round(c * 255.0)
+
+    @classmethod
+    def lab2rgb_array(cls, lab):
+        """Array variant of :meth:`lab2rgb`.
+        
+        :param lab: array of Lab colors"""
+        return cls.xyz2rgb_array(cls.lab2xyz_array(lab))
+
+    @classmethod
+    def rgb2hsv_array(cls, rgb):
+        """Array variant of :meth:`rgb2hsv`.
+        
+        :param rgb: array of RGB colors"""
+        rgb = numpy.asarray(rgb, dtype=numpy.float64) / 255.0
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        v = rgb.max(axis=-1)
+        x = rgb.min(axis=-1)
+        f = numpy.where(r == x, g - b, numpy.where(g == x, b - r, r - g))
+        i = numpy.where(r == x, 3.0, numpy.where(g == x, 5.0, 1.0))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            h = (i - f / (v - x)) * 60.0
+            h = h - numpy.floor(h/359.9) * 359.9 / 359.9   # h mod 359.9
+            s = (v - x) / v
+        gray = x == v
+        h[gray] = 0.0
+        s[gray] = 0.0
+        return _stack(h, s*100.0, v*100.0).astype(numpy.int_)
+
+    @classmethod
+    def hsv2rgb_array(cls, hsv):
+        """Array variant of :meth:`hsv2rgb`.
+        
+        :param hsv: array of HSV colors"""
+        hsv = numpy.asarray(hsv, dtype=numpy.float64)
+        h = numpy.clip(hsv[..., 0]/359.9, 0.0, 359.9)
+        s = numpy.clip(hsv[..., 1]/100.0, 0.0, 100.0)
+        v = numpy.clip(hsv[..., 2]/100.0, 0.0, 100.0)
+        h = h * 5.998
+        i = numpy.floor(h)
+        f = h - i
+        p = v * (1.0 - s)
+        q = v * (1.0 - (s * f))
+        t = v * (1.0 - (s * (1.0 - f)))
+        cases = [i == 0.0, i == 1.0, i == 2.0, i == 3.0, i == 4.0]
+        r = numpy.select(cases, [v, q, p, p, t], v)
+        g = numpy.select(cases, [t, v, v, q, p], p)
+        b = numpy.select(cases, [p, p, t, v, v], q)
+        result = _stack(r*255.0, g*255.0, b*255.0).astype(numpy.int_)
+        result[v == 0.0] = 0
+        return result
+
+
+class LookupTable(object):
+    """Memoized conversion of RGB colors into other colorspace. Each RGB color
+    is converted only once per process and all further conversions of that
+    color are simple lookups.
+    
+    Table can optionally be backed by a file containing precomputed values
+    for all 2**24 RGB colors. Such file is built once (if missing) and then
+    memory-mapped in read-only mode, so it is shared by all processes using
+    it and the conversion becomes pure indexed gather. Note that the file is
+    quite large (384 MiB for 3-channel ``float64`` values)."""
+    __instances = {}
+
+    def __init__(self, func, path=None):
+        """Create new lookup table.
+        
+        :param func: array conversion function taking array of RGB colors
+            (f.e. :meth:`Convert.rgb2lab_array`)
+        :param path: optional path to file with precomputed table. It will be
+            created if does not exist"""
+        self.func = func
+        self.path = path
+        self._keys = numpy.empty(0, dtype=numpy.uint32)
+        self._values = None
+        self._lut = None
+        if path:
+            if not os.path.isfile(path):
+                self.build(func, path)
+            self._lut = numpy.load(path, mmap_mode='r')
+
+    def __call__(self, rgb):
+        """Convert given array of RGB colors.
+        
+        :param rgb: array of RGB colors of shape ``(..., 3)``"""
+        rgb = numpy.asarray(rgb)
+        keys = pack(rgb.astype(numpy.uint8)).ravel()
+        if self._lut is not None:
+            values = self._lut[keys]
+        else:
+            values = self.__lookup(keys)
+        return values.reshape(rgb.shape[:-1] + values.shape[-1:])
+
+    def __lookup(self, keys):
+        """Return values for given packed RGB keys, converting and memoizing
+        those which were not converted yet."""
+        pos = numpy.searchsorted(self._keys, keys)
+        found = numpy.zeros(keys.shape, dtype=numpy.bool_)
+        inside = pos < self._keys.size
+        found[inside] = self._keys[pos[inside]] == keys[inside]
+        if not found.all():
+            missing = numpy.unique(keys[~found])
+            values = self.func(unpack(missing))
+            if self._values is None:
+                self._values = numpy.empty((0,) + values.shape[1:], dtype=values.dtype)
+            at = numpy.searchsorted(self._keys, missing)
+            self._keys = numpy.insert(self._keys, at, missing)
+            self._values = numpy.insert(self._values, at, values, axis=0)
+            pos = numpy.searchsorted(self._keys, keys)
+        return self._values[pos]
+
+    @classmethod
+    def build(cls, func, path, chunk=65536):
+        """Create file containing converted values of all RGB colors.
+        
+        :param func: array conversion function
+        :param path: path to resulting file
+        :param chunk: number of colors converted at once"""
+        log.info('building color lookup table: %s', path)
+        dirpath = os.path.dirname(path)
+        if dirpath and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        total = 1 << 24
+        sample = func(numpy.zeros((1, 3), dtype=numpy.uint8))
+        tmppath = "%s.%d.tmp" % (path, os.getpid())
+        lut = numpy.lib.format.open_memmap(
+            tmppath, mode='w+', dtype=sample.dtype,
+            shape=(total,) + sample.shape[1:])
+        try:
+            for start in xrange(0, total, chunk):
+                keys = numpy.arange(start, min(start + chunk, total), dtype=numpy.uint32)
+                lut[start:start+keys.size] = func(unpack(keys))
+            lut.flush()
+        finally:
+            del lut
+        # Other process might have been building same table, but renaming
+        # is atomic so readers always see complete file
+        os.rename(tmppath, path)
+
+    @classmethod
+    def instance(cls, func, path=None):
+        """Get or create lookup table for given conversion function. Tables
+        are shared by all callers within a process.
+        
+        :param func: array conversion function
+        :param path: optional path to precomputed table file"""
+        key = (func.__name__, path)
+        if key not in cls.__instances:
+            cls.__instances[key] = LookupTable(func, path=path)
+        return cls.__instances[key]
@@ -1,3 +1,8 @@
+import types
+import collections
+
+import numpy
+
 from camp.core import Image
 from camp.util import asunicode
 
@@ -60,26 +65,508 @@ class Text(BaseGenre):
             (self.__class__.__name__, self.text, self.horizontal)
 
 
+def _mixin(cls, *bases):
+    """Copy mixin methods (comparisons, intersection, difference etc.) of
+    given set ABCs to ``cls`` and register ``cls`` as virtual subclass of the
+    last one. Used by classes having ``__slots__``, as ABCs do not define
+    ``__slots__`` and inheriting from them would add ``__dict__`` to each
+    instance."""
+    for base in bases:
+        for name, value in base.__dict__.items():
+            if name in cls.__dict__ or getattr(value, '__isabstractmethod__', False):
+                continue
+            if isinstance(value, (types.FunctionType, classmethod)):
+                setattr(cls, name, value)
+    bases[-1].register(cls)
+
+
+def _merge_runs(starts, ends):
+    """Sort given runs and join runs that overlap or touch each other.
+    Returns ``(starts, ends)`` tuple of arrays."""
+    if not starts.size:
+        return starts, ends
+    order = numpy.argsort(starts, kind='mergesort')
+    starts, ends = starts[order], ends[order]
+    reach = numpy.maximum.accumulate(ends)
+    first = numpy.ones(starts.size, dtype=numpy.bool_)
+    first[1:] = starts[1:] > reach[:-1]
+    index = numpy.flatnonzero(first)
+    return starts[index], numpy.append(reach[index[1:] - 1], reach[-1])
+
+
+class PixelSet(object):
+    """Compact set of ``(x, y)`` pixel coordinates. Pixels are stored as
+    sorted runs of pixels lying next to each other in same row, so memory
+    used depends on number of runs instead of number of pixels. Pixels
+    added one by one are buffered and turned into runs once the set is
+    read.
+    
+    Each pixel is encoded as ``y << 32 | x`` integer key and each run is
+    stored as pair of keys of its first pixel and pixel following the last
+    one.
+    
+    Implements :class:`collections.MutableSet` interface."""
+    __slots__ = ('_starts', '_ends', '_pending', '_geometry')
+    _shift = 32
+    _xmask = (1 << 32) - 1
+
+    def __init__(self, iterable=None):
+        """Create new set of pixels.
+        
+        :param iterable: optional iterable of ``(x, y)`` tuples"""
+        self._set_runs(numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+        self._pending = []
+        if iterable is not None:
+            self.update(iterable)
+
+    @classmethod
+    def fromruns(cls, ys, starts, ends, normalized=False):
+        """Create set of pixels from given row runs.
+        
+        :param ys: array of row indices of runs
+        :param starts: array of X coordinates of first pixel of each run
+        :param ends: array of X coordinates of pixel following last pixel of
+            each run
+        :param normalized: if ``True``, runs are known to be sorted by row and
+            column and not to overlap or touch each other, so they are used
+            as they are"""
+        result = cls()
+        ys = numpy.asarray(ys, dtype=numpy.int64) << cls._shift
+        starts = ys | numpy.asarray(starts, dtype=numpy.int64)
+        ends = ys | numpy.asarray(ends, dtype=numpy.int64)
+        if not normalized:
+            starts, ends = _merge_runs(starts, ends)
+        result._set_runs(starts, ends)
+        return result
+
+    @classmethod
+    def fromkeys(cls, keys):
+        """Create set of pixels from given array of pixel keys."""
+        result = cls()
+        keys = numpy.unique(numpy.asarray(keys, dtype=numpy.int64))
+        if keys.size:
+            breaks = numpy.flatnonzero(numpy.diff(keys) != 1) + 1
+            result._set_runs(
+                keys[numpy.append(0, breaks)],
+                keys[numpy.append(breaks - 1, keys.size - 1)] + 1)
+        return result
+
+    def _flush(self):
+        """Turn pixels added one by one into runs."""
+        if self._pending:
+            pending = PixelSet.fromkeys(self._pending)
+            self._pending = []
+            self._set_runs(*_merge_runs(
+                numpy.concatenate((self._starts, pending._starts)),
+                numpy.concatenate((self._ends, pending._ends))))
+
+    def _set_runs(self, starts, ends):
+        """Replace runs of this set and forget its cached geometry."""
+        self._starts, self._ends = starts, ends
+        self._geometry = None
+
+    def __get_geometry(self):
+        """Return ``(count, bounds, sumx, sumy)`` tuple containing number of
+        pixels, bounds and sums of pixel coordinates. These are calculated
+        once and cached until the set is changed."""
+        if self._geometry is None:
+            ys, starts, ends = self.runs
+            lengths = ends - starts
+            if not lengths.size:
+                self._geometry = 0, None, 0, 0
+            else:
+                self._geometry = (
+                    int(lengths.sum()),
+                    (int(starts.min()), int(ys[0]), int(ends.max()) - 1, int(ys[-1])),
+                    int((lengths * (starts + ends - 1)).sum() // 2),
+                    int((lengths * ys).sum()))
+        return self._geometry
+
+    @property
+    def bounds(self):
+        """Bounds of pixels in this set as ``(left, top, right, bottom)``
+        tuple or ``None`` if the set is empty."""
+        return self.__get_geometry()[1]
+
+    @property
+    def sums(self):
+        """Tuple ``(sumx, sumy)`` of sums of X and Y coordinates of pixels
+        in this set."""
+        return self.__get_geometry()[2:]
+
+    @property
+    def runs(self):
+        """Tuple ``(ys, starts, ends)`` of arrays of row runs (see
+        :meth:`fromruns`)."""
+        self._flush()
+        return self._starts >> self._shift, self._starts & self._xmask,\
+            ((self._ends - 1) & self._xmask) + 1
+
+    def __contains__(self, pixel):
+        x, y = pixel
+        if x < 0 or y < 0:
+            return False
+        self._flush()
+        key = y << self._shift | x
+        i = self._starts.searchsorted(key, side='right') - 1
+        return i >= 0 and key < self._ends[i]
+
+    def __iter__(self):
+        self._flush()
+        shift, xmask = self._shift, self._xmask
+        for start, end in zip(self._starts.tolist(), self._ends.tolist()):
+            y = start >> shift
+            for x in xrange(start & xmask, end - start + (start & xmask)):
+                yield x, y
+
+    def __len__(self):
+        return self.__get_geometry()[0]
+
+    def add(self, pixel):
+        x, y = pixel
+        self._pending.append(y << self._shift | x)
+        self._geometry = None
+
+    def discard(self, pixel):
+        self._flush()
+        if pixel not in self:
+            return
+        x, y = pixel
+        key = y << self._shift | x
+        i = self._starts.searchsorted(key, side='right') - 1
+        starts = [self._starts[i], key + 1]
+        ends = [key, self._ends[i]]
+        keep = [j for j in (0, 1) if starts[j] < ends[j]]
+        self._set_runs(
+            numpy.concatenate((self._starts[:i], numpy.array(starts, dtype=numpy.int64)[keep], self._starts[i+1:])),
+            numpy.concatenate((self._ends[:i], numpy.array(ends, dtype=numpy.int64)[keep], self._ends[i+1:])))
+
+    def update(self, *iterables):
+        """Add pixels from all given iterables to this set."""
+        self._flush()
+        starts, ends = [self._starts], [self._ends]
+        for iterable in iterables:
+            if isinstance(iterable, PixelSet):
+                iterable._flush()
+                starts.append(iterable._starts)
+                ends.append(iterable._ends)
+            else:
+                for pixel in iterable:
+                    self.add(pixel)
+        if len(starts) > 1:
+            self._set_runs(*_merge_runs(
+                numpy.concatenate(starts), numpy.concatenate(ends)))
+
+    def union(self, *others):
+        """Return new set containing pixels of this set and all given
+        sets."""
+        result = PixelSet()
+        result.update(self, *others)
+        return result
+
+    def copy(self):
+        """Return copy of this set."""
+        return self.union()
+
+    def __or__(self, other):
+        if not isinstance(other, collections.Set):
+            return NotImplemented
+        return self.union(other)
+
+    __ror__ = __or__
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __getstate__(self):
+        self._flush()
+        return self._starts, self._ends
+
+    def __setstate__(self, state):
+        self._set_runs(*state)
+        self._pending = []
+
+    def __repr__(self):
+        return "%s(npixels=%d, nruns=%d)" % (self.__class__.__name__, len(self), self._starts.size)
+
+    __hash__ = None
+
+
+_mixin(PixelSet, collections.Set, collections.MutableSet)
+
+
+class LabelPixelSet(PixelSet):
+    """Set of pixels having given label in a label array. Used to keep large
+    segments (f.e. background of the image) without creating pixel runs.
+    Runs are created once the set is modified, combined with other sets or
+    pickled."""
+    __slots__ = ('_labels', '_label')
+
+    def __init__(self, labels, label, count, bounds, sums):
+        """Create new set of pixels backed by label array.
+        
+        :param labels: label array of shape ``(height, width)``
+        :param label: label of pixels in this set
+        :param count: number of pixels having given label
+        :param bounds: bounds of pixels having given label
+        :param sums: sums of X and Y coordinates of pixels having given
+            label"""
+        super(LabelPixelSet, self).__init__()
+        self._labels, self._label = labels, label
+        self._geometry = (count, tuple(bounds)) + tuple(sums)
+
+    def _flush(self):
+        if self._labels is not None:
+            labels, geometry = self._labels, self._geometry
+            left, top, right, bottom = geometry[1]
+            mask = labels[top:bottom+1, left:right+1] == self._label
+            first, last = mask.copy(), mask.copy()
+            first[:, 1:] &= ~mask[:, :-1]
+            last[:, :-1] &= ~mask[:, 1:]
+            ys, starts = numpy.nonzero(first)
+            ends = numpy.nonzero(last)[1] + 1
+            del first, last, mask
+            runs = PixelSet.fromruns(ys + top, starts + left, ends + left, normalized=True)
+            self._labels = None
+            self._set_runs(runs._starts, runs._ends)
+            self._geometry = geometry
+        super(LabelPixelSet, self)._flush()
+
+    def add(self, pixel):
+        self._flush()  # Geometry of labelled pixels is needed to create runs
+        super(LabelPixelSet, self).add(pixel)
+
+    def __contains__(self, pixel):
+        if self._labels is None:
+            return super(LabelPixelSet, self).__contains__(pixel)
+        x, y = pixel
+        height, width = self._labels.shape
+        return 0 <= x < width and 0 <= y < height and self._labels[y, x] == self._label
+
+    def __iter__(self):
+        if self._labels is None:
+            for pixel in super(LabelPixelSet, self).__iter__():
+                yield pixel
+            return
+        left, top, right, bottom = self._geometry[1]
+        for y in xrange(top, bottom + 1):
+            row = numpy.flatnonzero(self._labels[y, left:right+1] == self._label) + left
+            for x in row.tolist():
+                yield x, y
+
+    def __setstate__(self, state):
+        super(LabelPixelSet, self).__setstate__(state)
+        self._labels = None
+
+
+class SegmentGraph(object):
+    """Undirected graph of segments stored in compressed sparse row format.
+    Indices of neighbours of ``i``-th segment are stored in ascending order
+    in ``indices[indptr[i]:indptr[i+1]]``. Single graph is shared by all
+    segments extracted from an image."""
+    __slots__ = ('indptr', 'indices')
+
+    def __init__(self, indptr, indices):
+        self.indptr = numpy.asarray(indptr, dtype=numpy.int64)
+        self.indices = numpy.asarray(indices, dtype=numpy.int32)
+
+    @classmethod
+    def frompairs(cls, n, pairs):
+        """Create graph of ``n`` segments having edges given as array of
+        ``(a, b)`` pairs of segment indices."""
+        pairs = numpy.asarray(pairs, dtype=numpy.int64).reshape(-1, 2)
+        a = numpy.concatenate((pairs[:, 0], pairs[:, 1]))
+        b = numpy.concatenate((pairs[:, 1], pairs[:, 0]))
+        order = numpy.lexsort((b, a))
+        indptr = numpy.append(0, numpy.cumsum(numpy.bincount(a, minlength=n)))
+        return cls(indptr, b[order])
+
+    def __len__(self):
+        return self.indptr.size - 1
+
+    def __getitem__(self, i):
+        """Return array of indices of neighbours of ``i``-th segment."""
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def __getstate__(self):
+        return self.indptr, self.indices
+
+    def __setstate__(self, state):
+        self.indptr, self.indices = state
+
+
+class NeighbourSet(object):
+    """Read-only set of indices of neighbours of single segment, backed by
+    :class:`SegmentGraph`."""
+    __slots__ = ('_graph', '_index')
+
+    def __init__(self, graph, index):
+        self._graph = graph
+        self._index = index
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __contains__(self, index):
+        row = self._graph[self._index]
+        i = row.searchsorted(index)
+        return i < row.size and row[i] == index
+
+    def __iter__(self):
+        return iter(self._graph[self._index].tolist())
+
+    def __len__(self):
+        return int(self._graph.indptr[self._index+1] - self._graph.indptr[self._index])
+
+    def __getstate__(self):
+        return self._graph, self._index
+
+    def __setstate__(self, state):
+        self._graph, self._index = state
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, list(self))
+
+    __hash__ = None
+
+_mixin(NeighbourSet, collections.Set)
+
+
+class LabelMap(object):
+    """Array assigning each pixel of the image to a segment: pixel ``(x, y)``
+    belongs to the segment which :attr:`Segment.index` equals
+    ``array[y, x]``. Labels are stored as ``uint16`` if possible or as
+    ``int32`` otherwise. Masks of segments and segment groups can be cropped
+    from the map much faster than built from their pixel sets."""
+    __slots__ = ('_array',)
+
+    def __init__(self, array):
+        """Create new label map.
+        
+        :param array: label array of shape ``(height, width)``"""
+        array = numpy.asarray(array)
+        if array.size and array.max() > numpy.iinfo(numpy.uint16).max:
+            self._array = numpy.ascontiguousarray(array, dtype=numpy.int32)
+        else:
+            self._array = numpy.ascontiguousarray(array, dtype=numpy.uint16)
+
+    @property
+    def array(self):
+        """Label array of shape ``(height, width)``. Should not be
+        modified."""
+        return self._array
+
+    @property
+    def width(self):
+        return self._array.shape[1]
+
+    @property
+    def height(self):
+        return self._array.shape[0]
+
+    def __getitem__(self, pixel):
+        """Return label of pixel ``(x, y)``."""
+        x, y = pixel
+        return int(self._array[y, x])
+
+    @staticmethod
+    def indices(segment):
+        """Return list of labels of pixels of given segment. For segment
+        groups this is list of indices of all segments in the group (groups
+        of groups are traversed recursively)."""
+        result, stack = [], [segment]
+        while stack:
+            s = stack.pop()
+            children = getattr(s, 'segments', None)
+            if children is None:
+                result.append(s.index)
+            else:
+                stack.extend(children)
+        return result
+
+    def __select(self, window, indices):
+        """Return boolean mask of pixels of ``window`` having one of given
+        labels."""
+        if len(indices) == 1:
+            return window == indices[0]
+        return numpy.in1d(window, indices).reshape(window.shape)
+
+    def crop(self, segment, border=0, edges=False):
+        """Return boolean mask of pixels of given segment (or segment group)
+        cropped to bounds of the segment. Mask has shape ``(height +
+        2*border, width + 2*border)``, where ``width`` and ``height`` are
+        dimensions of the segment.
+        
+        :param segment: segment or segment group from image this map was
+            created for
+        :param border: number of unmarked pixels surrounding the segment
+        :param edges: if ``True``, only pixels having at least one neighbour
+            (8-connectivity) not belonging to the segment are marked. This
+            gives same pixels as :attr:`Segment.border` for single segments"""
+        bounds = segment.bounds
+        if not bounds or bounds[0] < 0:
+            return numpy.zeros((2 * border, 2 * border), dtype=numpy.bool_)
+        left, top, right, bottom = bounds
+        indices = self.indices(segment)
+        result = numpy.zeros(
+            (bottom - top + 1 + 2 * border, right - left + 1 + 2 * border), dtype=numpy.bool_)
+        inner = result[border:result.shape[0]-border, border:result.shape[1]-border]
+        if not edges:
+            inner[:] = self.__select(self._array[top:bottom+1, left:right+1], indices)
+            return result
+        # Pixels outside of the image are treated as belonging to the
+        # segment, as image bounds are not part of segment border
+        height, width = self._array.shape
+        outer = numpy.ones((bottom - top + 3, right - left + 3), dtype=numpy.bool_)
+        y0, x0, y1, x1 = max(top - 1, 0), max(left - 1, 0), min(bottom + 2, height), min(right + 2, width)
+        outer[y0-top+1:y1-top+1, x0-left+1:x1-left+1] = self.__select(self._array[y0:y1, x0:x1], indices)
+        inside = outer[1:-1, 1:-1]
+        surrounded = inside.copy()
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                surrounded &= outer[dy:dy+inside.shape[0], dx:dx+inside.shape[1]]
+        numpy.logical_and(inside, ~surrounded, out=inner)
+        return result
+
+    def __getstate__(self):
+        return self._array,
+
+    def __setstate__(self, state):
+        self._array, = state
+
+    def __repr__(self):
+        return "<%s(width=%d, height=%d, dtype=%s)>" %\
+            (self.__class__.__name__, self.width, self.height, self._array.dtype)
+
+
 class Segment(object):
     """Container that holds single extracted segment from image. Each segment
     instance has following public properties (with read and write access):
     
     :param index: unique index of this segment
     :param color: original color of pixels listed in :param:`area`
-    :param area: set of ``(x,y)`` tuples of pixel coordinates
+    :param area: set of ``(x,y)`` tuples of pixel coordinates (instance of
+        :class:`PixelSet`)
     :parma neighbours: set of indices of segments adjacent to current one"""
+    __slots__ = ('_index', '_color', '_area', '_border', '_neighbours', '_genre')
     
-    def __init__(self, index, color):
+    def __init__(self, index, color, area=None, border=None, neighbours=None):
         """Create new segment.
         
         :param index: unique integer index of this segment. Indices are used to
             provide neighbourhood relationship between segments
-        :param color: color of this object used in image"""
+        :param color: color of this object used in image
+        :param area: optional :class:`PixelSet` of segment pixels
+        :param border: optional :class:`PixelSet` of border pixels
+        :param neighbours: optional set of neighbour indices (f.e.
+            :class:`NeighbourSet`)"""
         self._index = index
         self._color = color
-        self._area = set()
-        self._border = set()
-        self._neighbours = set()
+        self._area = PixelSet() if area is None else area
+        self._border = PixelSet() if border is None else border
+        self._neighbours = set() if neighbours is None else neighbours
         self._genre = None
     
     @property
@@ -121,29 +608,27 @@ class Segment(object):
     def bounds(self):
         """Return bounds of this extracted object as a tuple of ``(left, top,
         right, bottom)``."""
-        if not self.area:
-            return
-        return self.left, self.top, self.right, self.bottom
+        return self.area.bounds
     
     @property
     def left(self):
         """X coordinate of top left hand corner."""
-        return min(self.area or [(-1, -1)], key=lambda x: x[0])[0]
+        return (self.area.bounds or (-1, -1, -1, -1))[0]
 
     @property
     def top(self):
         """Y coordinate of top left hand corner."""
-        return min(self.area or [(-1, -1)], key=lambda x: x[1])[1]
+        return (self.area.bounds or (-1, -1, -1, -1))[1]
 
     @property
     def right(self):
         """X coordinate of bottom right hand corner."""
-        return max(self.area or [(-1, -1)], key=lambda x: x[0])[0]
+        return (self.area.bounds or (-1, -1, -1, -1))[2]
 
     @property
     def bottom(self):
         """Y coordinate of bottom right hand corner."""
-        return max(self.area or [(-1, -1)], key=lambda x: x[1])[1]
+        return (self.area.bounds or (-1, -1, -1, -1))[3]
 
     @property
     def width(self):
@@ -158,8 +643,7 @@ class Segment(object):
     @property
     def barycenter(self):
         """Segment's barycenter coordinates."""
-        x = sum([a[0] for a in self.area])
-        y = sum([a[1] for a in self.area])
+        x, y = self.area.sums
         l = float(len(self.area))
         return x / l, y / l
     
@@ -188,7 +672,7 @@ class Segment(object):
         the segment."""
         return float(self.width) / float(self.height)
 
-    def toimage(self, mode='L', color=255, background=0, border=0, angle=None):
+    def toimage(self, mode='L', color=255, background=0, border=0, angle=None, labels=None):
         """Convert this segment to image.
         
         :param mode: mode of resulting image
@@ -197,12 +681,19 @@ class Segment(object):
             border of background color if value is greater than 0)
         :param angle: can be used to create rotated image (usefull for OCR to
             recognize vertical text segments by rotating them to be a
-            horizontal text segments)"""
-        result = Image.create(mode, self.width + 2 * border, self.height + 2 * border, background=background)
-        p = result.pixels
-        l, t = self.left, self.top
-        for x, y in self.area:
-            p[x-l+border, y-t+border] = color
+            horizontal text segments)
+        :param labels: optional :class:`LabelMap` of the image containing
+            this segment. If given, segment mask is cropped from it instead of
+            being built from :attr:`area`"""
+        width, height = self.width + 2 * border, self.height + 2 * border
+        result = Image.create(mode, width, height, background=background)
+        if labels is not None:
+            mask = labels.crop(self, border=border)
+        else:
+            coords = numpy.array(list(self.area)).reshape(-1, 2)
+            mask = numpy.zeros((height, width), dtype=numpy.bool_)
+            mask[coords[:, 1] - self.top + border, coords[:, 0] - self.left + border] = True
+        result.fill(color, mask=Image.fromarray(mask))
         if angle:
             return result.rotate(angle)
         else:
@@ -250,26 +741,88 @@ class Segment(object):
         for x, y in self.border:
             p[x, y] = color
 
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def __repr__(self):
         """Return text representation of this object."""
         return "<%s(npixels=%d, bounds=%s, genre=%s)>" %\
             (self.__class__.__name__, len(self.area), self.bounds, self.genre)
 
 
+class SegmentSet(set):
+    """Set of segments counting its modifications. Used by
+    :class:`SegmentGroup` to find out if values cached for its segments are
+    still valid.
+    
+    :attr version: number of modifications made to this set"""
+
+    def __init__(self, iterable=()):
+        super(SegmentSet, self).__init__(iterable)
+        self.version = 0
+
+
+def _modifying(name):
+    method = getattr(set, name)
+    def proxy(self, *args):
+        self.version += 1
+        return method(self, *args)
+    proxy.__name__ = name
+    proxy.__doc__ = method.__doc__
+    return proxy
+
+for _name in (
+        'add', 'clear', 'discard', 'pop', 'remove', 'update',
+        'difference_update', 'intersection_update',
+        'symmetric_difference_update', '__ior__', '__iand__', '__isub__',
+        '__ixor__'):
+    setattr(SegmentSet, _name, _modifying(_name))
+
+
 class SegmentGroup(Segment):
-    """Groups two or more segments."""
+    """Groups two or more segments. Area and neighbours of the group are
+    calculated once and cached until :attr:`segments` set is modified."""
+    __slots__ = ('_segments', '_cache')
     
     def __init__(self, index, segments=None):
         """Create new segment group instance.
         
         :param index: index assigned to this segment group"""
         super(SegmentGroup, self).__init__(index=index, color=None)
-        self._segments = set(segments or [])
+        self._segments = SegmentSet(segments or [])
+        self._cache = {}
     
     @property
     def segments(self):
         return self._segments
 
+    def __getstate__(self):
+        state = super(SegmentGroup, self).__getstate__()
+        del state['_cache']  # Rebuilt on first access
+        return state
+
+    def __setstate__(self, state):
+        super(SegmentGroup, self).__setstate__(state)
+        self._cache = {}
+
+    def __cached(self, key, func):
+        """Return value of ``func()`` cached under given ``key`` for current
+        version of :attr:`segments` set."""
+        version = self._segments.version
+        cached = self._cache.get(key)
+        if cached is None or cached[0] != version:
+            cached = self._cache[key] = version, func()
+        return cached[1]
+
     @property
     def genre(self):
         """Genre of this segment group."""
@@ -285,11 +838,11 @@ class SegmentGroup(Segment):
     @property
     def area(self):
         """Area of this segment group (union of all underlying segment
-        areas)."""
-        return set.union(*[s.area for s in self.segments])
+        areas). Should not be modified."""
+        return self.__cached('area', lambda: PixelSet.union(*[s.area for s in self.segments]))
 
     @property
     def neighbours(self):
         """Neighbours of this segment (union of all underlying segment
-        neighbours)."""
-        return set.union(*[s.neighbours for s in self.segments])
+        neighbours). Should not be modified."""
+        return self.__cached('neighbours', lambda: set().union(*[s.neighbours for s in self.segments]))
@@ -0,0 +1,497 @@
+"""Connected component labeling of images.
+
+Pixels having same color and touching each other (8-connectivity) are given
+same label. Labeling is done in two passes over horizontal runs of
+same-colored pixels instead of single pixels:
+
+1. Split each row into runs and find pairs of touching runs of same color in
+   adjacent rows. Number of runs checked does not depend on run lengths.
+2. Join touching runs using union-find and relabel pixels.
+
+Labels are numbered in raster order of first pixel of each component (first
+component contains top left pixel of the image)."""
+import heapq
+import itertools
+
+import numpy
+
+from camp.core import pack
+
+
+def _runs(array):
+    """Split each row of 2D ``array`` into runs of equal values. Returns
+    ``(runs, starts)`` tuple, where ``runs`` is array of run indices of each
+    pixel (having same shape as ``array``) and ``starts`` is array of flat
+    indices of first pixel of each run."""
+    first = numpy.ones(array.shape, dtype=numpy.bool_)
+    first[:, 1:] = array[:, 1:] != array[:, :-1]
+    runs = numpy.cumsum(first.ravel(), dtype=numpy.int32).reshape(array.shape)
+    runs -= 1
+    return runs, numpy.flatnonzero(first)
+
+
+def _edges(array, runs, starts):
+    """Return ``(a, b)`` tuple of arrays of indices of touching runs of same
+    color in adjacent rows. Pair of runs found at given column stays the same
+    until run in one of rows ends, so it is enough to check pixels adjacent
+    to first pixel of each run."""
+    height, width = array.shape
+    flat, values = runs.ravel(), array.ravel()
+    y, x = starts // width, starts % width
+    result_a, result_b = [], []
+    for dy in (-1, 1):
+        for dx in (-1, 0, 1):
+            valid = (y + dy >= 0) & (y + dy < height) & (x + dx >= 0) & (x + dx < width)
+            src = starts[valid]
+            dst = src + dy * width + dx
+            same = values[src] == values[dst]
+            result_a.append(flat[src[same]])
+            result_b.append(flat[dst[same]])
+    return numpy.concatenate(result_a), numpy.concatenate(result_b)
+
+
+def _union_find(n, a, b):
+    """Join ``n`` elements connected by ``(a[i], b[i])`` edges. Returns
+    array of roots of each element. Root of each set is its smallest
+    element. All edges are processed at once in each iteration: roots of
+    both ends of each edge are linked to smaller of them and paths are
+    compressed until each element points directly to its root."""
+    parent = numpy.arange(n, dtype=numpy.int32)
+    while a.size:
+        ra, rb = parent[a], parent[b]
+        differ = ra != rb
+        if not differ.any():
+            break
+        ra, rb = ra[differ], rb[differ]
+        # Link larger root of each edge to smallest root connected with it
+        hi, lo = numpy.maximum(ra, rb), numpy.minimum(ra, rb)
+        order = numpy.lexsort((lo, hi))
+        hi, lo = hi[order], lo[order]
+        first = numpy.ones(hi.size, dtype=numpy.bool_)
+        first[1:] = hi[1:] != hi[:-1]
+        hi, lo = hi[first], lo[first]
+        parent[hi] = lo
+        # Compress paths
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+        a, b = a[differ], b[differ]
+    return parent
+
+
+def label(array):
+    """Label connected components of same-colored pixels of given image
+    array. Returns ``(labels, stats)`` tuple, where ``labels`` is array of
+    ``int32`` labels having shape ``(height, width)`` and ``stats`` is a dict
+    of arrays indexed by label, containing:
+
+    ``first``
+        flat index of first (in raster order) pixel of each component
+    ``count``
+        number of pixels
+    ``left``, ``top``, ``right``, ``bottom``
+        bounding box of component (with ``right`` and ``bottom`` included)
+    ``sumx``, ``sumy``
+        sums of X and Y coordinates of pixels
+
+    :param array: array of shape ``(height, width)`` or ``(height, width,
+        nchannels)``"""
+    array = numpy.asarray(array)
+    if array.ndim == 3:
+        array = pack(array)
+    height, width = array.shape
+    runs, starts = _runs(array)
+    a, b = _edges(array, runs, starts)
+    parent = _union_find(starts.size, a, b)
+    # Roots are numbered in raster order, so rank of root is the label
+    roots = numpy.flatnonzero(parent == numpy.arange(starts.size))
+    run_labels = numpy.searchsorted(roots, parent).astype(numpy.int32)
+    labels = run_labels[runs]
+    # Calculate statistics of runs and merge them for each label
+    order = numpy.argsort(run_labels, kind='mergesort')
+    ys, xs = starts // width, starts % width
+    ends = numpy.diff(numpy.append(starts, height * width)) + xs
+    return labels, _statistics(run_labels[order], ys[order], xs[order], ends[order], roots.size, width)
+
+
+def _boxes(height, width, tile_size):
+    """Yield ``(top, left, bottom, right)`` boxes of tiles covering image of
+    given size in raster order (``bottom`` and ``right`` are excluded)."""
+    for top in xrange(0, height, tile_size):
+        for left in xrange(0, width, tile_size):
+            yield top, left, min(top + tile_size, height), min(left + tile_size, width)
+
+
+def _colors(array):
+    """Return array of packed colors of given image array."""
+    return pack(array) if array.ndim == 3 else array
+
+
+def _seam_edges(array, labels, tile_size):
+    """Return ``(a, b)`` tuple of arrays of labels of same-colored pixels
+    touching each other (8-connectivity) across tile seams. Only two rows or
+    columns of pixels along each seam are compared."""
+    height, width = labels.shape
+    result_a, result_b = [numpy.zeros(0, dtype=numpy.int32)], [numpy.zeros(0, dtype=numpy.int32)]
+    shifted = ((slice(None), slice(None)), (slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1)))
+    for x in xrange(tile_size, width, tile_size):
+        colors, seam = _colors(array[:, x-1:x+1]), labels[:, x-1:x+1]
+        for src, dst in shifted:
+            same = colors[src, 0] == colors[dst, 1]
+            result_a.append(seam[src, 0][same])
+            result_b.append(seam[dst, 1][same])
+    for y in xrange(tile_size, height, tile_size):
+        colors, seam = _colors(array[y-1:y+1]), labels[y-1:y+1]
+        for src, dst in shifted:
+            same = colors[0, src] == colors[1, dst]
+            result_a.append(seam[0, src][same])
+            result_b.append(seam[1, dst][same])
+    return numpy.concatenate(result_a), numpy.concatenate(result_b)
+
+
+def _reduce(ufunc, index, values, n, initial):
+    """Reduce ``values`` having same ``index`` using given ufunc. Returns
+    array of ``n`` results."""
+    result = numpy.repeat(numpy.asarray(initial, dtype=values.dtype), n)
+    ufunc.at(result, index, values)
+    return result
+
+
+def _merge_statistics(stats, groups, n):
+    """Merge statistics of components joined into ``n`` groups, where
+    ``groups[i]`` is group of ``i``-th component. Groups are numbered in
+    raster order of their first pixel. Returns ``(mapping, stats)`` tuple,
+    where ``mapping[i]`` is number of group of ``i``-th component."""
+    big = numpy.iinfo(numpy.int64).max
+    first = _reduce(numpy.minimum, groups, stats['first'], n, big)
+    order = numpy.argsort(first, kind='mergesort')
+    rank = numpy.empty(n, dtype=numpy.int32)
+    rank[order] = numpy.arange(n)
+    mapping = rank[groups]
+    return mapping, {
+        'first': first[order],
+        'count': _reduce(numpy.add, mapping, stats['count'], n, 0),
+        'left': _reduce(numpy.minimum, mapping, stats['left'], n, big),
+        'top': _reduce(numpy.minimum, mapping, stats['top'], n, big),
+        'right': _reduce(numpy.maximum, mapping, stats['right'], n, -1),
+        'bottom': _reduce(numpy.maximum, mapping, stats['bottom'], n, -1),
+        'sumx': _reduce(numpy.add, mapping, stats['sumx'], n, 0),
+        'sumy': _reduce(numpy.add, mapping, stats['sumy'], n, 0)}
+
+
+def _strips(height, width, tile_size):
+    """Yield ``(top, bottom)`` tuples of row ranges of horizontal strips
+    covering image of given size. Each strip has about ``tile_size**2``
+    pixels (at least one row) or, if ``tile_size`` is 0, single strip covers
+    entire image."""
+    rows = max(1, tile_size * tile_size // max(width, 1)) if tile_size else max(height, 1)
+    for top in xrange(0, height, rows):
+        yield top, min(top + rows, height)
+
+
+def _relabel(labels, mapping, tile_size):
+    """Replace each label of ``labels`` array with ``mapping[label]`` in
+    place, strip by strip."""
+    for top, bottom in _strips(labels.shape[0], labels.shape[1], tile_size):
+        labels[top:bottom] = mapping[labels[top:bottom]]
+
+
+def label_tiled(array, tile_size, mapper=None):
+    """Same as :func:`label`, but labels square tiles of the image
+    independently and then joins components touching each other across tile
+    seams. Temporary arrays created while labeling are bounded by tile
+    size, only the resulting label array covers entire image.
+    
+    :param array: array of shape ``(height, width)`` or ``(height, width,
+        nchannels)``
+    :param tile_size: length of tile edge in pixels
+    :param mapper: ``imap``-like function used to call :func:`label` for
+        each tile, f.e. :meth:`multiprocessing.Pool.imap` to label tiles in
+        parallel. Must return results in order of tiles (defaults to
+        :func:`itertools.imap`)"""
+    array = numpy.asarray(array)
+    height, width = array.shape[:2]
+    labels = numpy.empty((height, width), dtype=numpy.int32)
+    boxes = list(_boxes(height, width, tile_size))
+    results = (mapper or itertools.imap)(
+        label, (array[top:bottom, left:right] for top, left, bottom, right in boxes))
+    parts, offset = [], 0
+    for (top, left, bottom, right), (tile_labels, stats) in itertools.izip(boxes, results):
+        numpy.add(tile_labels, offset, out=labels[top:bottom, left:right])
+        # Move statistics of tile components into image coordinates
+        count = stats['count']
+        stats['first'] = (stats['first'] // (right - left) + top) * width + stats['first'] % (right - left) + left
+        for key, shift in (('left', left), ('right', left), ('top', top), ('bottom', top)):
+            stats[key] += shift
+        stats['sumx'] += count * left
+        stats['sumy'] += count * top
+        parts.append(stats)
+        offset += count.size
+    if not parts:
+        return label(array)
+    stats = dict((k, numpy.concatenate([p[k] for p in parts])) for k in parts[0])
+    # Join tile components across seams
+    a, b = _seam_edges(array, labels, tile_size)
+    keys = numpy.unique(a.astype(numpy.int64) * offset + b)
+    parent = _union_find(offset, (keys // offset).astype(numpy.int32), (keys % offset).astype(numpy.int32))
+    roots = numpy.flatnonzero(parent == numpy.arange(offset))
+    # Number joined components in raster order of their first pixel
+    mapping, stats = _merge_statistics(stats, numpy.searchsorted(roots, parent), roots.size)
+    _relabel(labels, mapping, tile_size)
+    return labels, stats
+
+
+def _statistics(owners, ys, starts, ends, n, width):
+    """Calculate statistics of ``n`` labels from row runs sorted by label and
+    then in raster order (see :func:`runs` and :func:`label`)."""
+    bounds = numpy.searchsorted(owners, numpy.arange(n))
+    lengths = ends - starts
+    return {
+        'first': ys[bounds] * width + starts[bounds],
+        'count': numpy.bincount(owners, weights=lengths, minlength=n).astype(numpy.int64),
+        'left': numpy.minimum.reduceat(starts, bounds),
+        'top': ys[bounds],
+        'right': numpy.maximum.reduceat(ends - 1, bounds),
+        'bottom': numpy.maximum.reduceat(ys, bounds),
+        'sumx': numpy.bincount(owners, weights=lengths * (starts + ends - 1) // 2, minlength=n).astype(numpy.int64),
+        'sumy': numpy.bincount(owners, weights=lengths * ys, minlength=n).astype(numpy.int64)}
+
+
+def statistics(labels):
+    """Calculate statistics of each label of given label array, which labels
+    are numbered from 0 without gaps. See :func:`label` for details."""
+    labels = numpy.asarray(labels)
+    owners, ys, starts, ends = runs(labels)
+    return _statistics(owners, ys, starts, ends, int(labels.max()) + 1, labels.shape[1])
+
+
+def runs(labels, mask=None):
+    """Split rows of given label array into runs of equal labels. Returns
+    ``(owners, ys, starts, ends)`` tuple of arrays containing label, row
+    index, X coordinate of first pixel and X coordinate of pixel following
+    last pixel of each run. Runs are sorted by label and then in raster
+    order.
+    
+    :param labels: label array of shape ``(height, width)``
+    :param mask: optional boolean array of same shape. If given, only pixels
+        marked in ``mask`` are split into runs"""
+    labels = numpy.asarray(labels)
+    height, width = labels.shape
+    if mask is not None:
+        labels = numpy.where(mask, labels, -1)
+    runs, starts = _runs(labels)
+    ends = numpy.append(starts[1:], height * width)
+    owners = labels.ravel()[starts]
+    if mask is not None:
+        used = owners >= 0
+        starts, ends, owners = starts[used], ends[used], owners[used]
+    order = numpy.argsort(owners, kind='mergesort')
+    starts, ends, owners = starts[order], ends[order], owners[order]
+    ys = starts // width
+    return owners, ys, starts - ys * width, ends - ys * width
+
+
+_shifts = (
+    ((slice(None), slice(None, -1)), (slice(None), slice(1, None))),          # E
+    ((slice(None, -1), slice(None)), (slice(1, None), slice(None))),          # S
+    ((slice(None, -1), slice(None, -1)), (slice(1, None), slice(1, None))),   # SE
+    ((slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1))))   # SW
+
+
+def _differences(labels):
+    """For each of E, S, SE and SW directions yield ``(src, dst, differ)``
+    tuple, where ``src`` and ``dst`` are slices selecting pixels and their
+    neighbours in given direction and ``differ`` is boolean array marking
+    pairs of pixels having different labels."""
+    for src, dst in _shifts:
+        yield src, dst, labels[src] != labels[dst]
+
+
+def _pair_keys(labels, src, dst, differ, n):
+    """Return array of ``min(a, b) * n + max(a, b)`` keys of label pairs
+    ``(a, b)`` marked in ``differ``, where ``n`` is number of labels."""
+    a, b = labels[src][differ].astype(numpy.int64), labels[dst][differ].astype(numpy.int64)
+    return numpy.minimum(a, b) * n + numpy.maximum(a, b)
+
+
+def adjacency(labels):
+    """Find pairs of adjacent (8-connectivity) labels and border pixels of
+    given label array by comparing the array with its copies shifted in E,
+    S, SE and SW directions. Returns ``(pairs, border)`` tuple, where
+    ``pairs`` is array of shape ``(n, 2)`` of unique ``(a, b)`` label pairs
+    with ``a < b`` and ``border`` is boolean array marking pixels having at
+    least one neighbour with different label.
+    
+    :param labels: label array of shape ``(height, width)``"""
+    labels = numpy.asarray(labels)
+    n = numpy.int64(labels.max()) + 1 if labels.size else 1
+    border = numpy.zeros(labels.shape, dtype=numpy.bool_)
+    keys = [numpy.zeros(0, dtype=numpy.int64)]
+    for src, dst, differ in _differences(labels):
+        border[src] |= differ
+        border[dst] |= differ
+        keys.append(numpy.unique(_pair_keys(labels, src, dst, differ, n)))
+    keys = numpy.unique(numpy.concatenate(keys))
+    return numpy.column_stack((keys // n, keys % n)), border
+
+
+def _describe_strip(args):
+    """Process single strip of label array for :func:`describe`. ``args`` is
+    ``(window, start, stop, n, background, pixels)`` tuple, where ``window``
+    contains rows of the strip (``window[start:stop]``) surrounded by single
+    rows of adjacent strips, if any. Returns ``(keys, lengths, area,
+    border)`` tuple, where ``keys`` and ``lengths`` are unique keys of pairs
+    of adjacent labels (see :func:`_pair_keys`) and number of pairs of
+    adjacent pixels found for each key, while ``area`` and ``border`` are
+    runs (see :func:`runs`) of pixels and border pixels of the strip (or
+    ``None`` if ``pixels`` is not set). Pairs of pixels are counted only in
+    strip containing upper (or left, for pairs within single row) pixel of
+    the pair, so each pair is counted exactly once."""
+    window, start, stop, n, background, pixels = args
+    border = numpy.zeros(window.shape, dtype=numpy.bool_) if pixels else None
+    keys = [numpy.zeros(0, dtype=numpy.int64)]
+    for src, dst, differ in _differences(window):
+        if pixels:
+            border[src] |= differ
+            border[dst] |= differ
+        # Rows of ``differ`` are rows of first pixel of each pair
+        if start > 0 or stop < differ.shape[0]:
+            differ[:start] = False
+            differ[stop:] = False
+        keys.append(_pair_keys(window, src, dst, differ, n))
+    keys, lengths = numpy.unique(numpy.concatenate(keys), return_counts=True)
+    if not pixels:
+        return keys, lengths, None, None
+    inner = window[start:stop]
+    area = runs(inner, mask=None if background is None else inner != background)
+    return keys, lengths, area, runs(inner, mask=border[start:stop])
+
+
+def _concatenate_runs(parts):
+    """Join runs of consecutive strips given as ``(top, runs)`` tuples into
+    runs of entire image sorted by label and then in raster order."""
+    owners, ys, starts, ends = [
+        numpy.concatenate([p[i] + (top if i == 1 else 0) for top, p in parts])
+        for i in xrange(4)]
+    order = numpy.argsort(owners, kind='mergesort')
+    return owners[order], ys[order], starts[order], ends[order]
+
+
+def describe(labels, n, tile_size=0, background=None, mapper=None, pixels=True):
+    """Find everything needed to create segments from label array: pairs of
+    adjacent (8-connectivity) labels, lengths of boundaries between them and
+    runs of pixels and border pixels of each label. Label array is processed
+    in horizontal strips having about ``tile_size**2`` pixels, so temporary
+    arrays are bounded by tile size. Returns dict containing:
+
+    ``pairs``
+        array of shape ``(m, 2)`` of unique ``(a, b)`` pairs of adjacent
+        labels with ``a < b`` (same as given by :func:`adjacency`)
+    ``lengths``
+        number of pairs of adjacent pixels having labels of each pair
+    ``area``, ``border``
+        runs (see :func:`runs`) of pixels and of border pixels (pixels
+        having at least one neighbour with different label) of each label
+
+    :param labels: label array of shape ``(height, width)``
+    :param n: number of labels
+    :param tile_size: see :func:`label_tiled` (0 processes entire image at
+        once)
+    :param background: optional label which pixels are not included in
+        ``area`` runs
+    :param mapper: ``imap``-like function used to process strips (see
+        :func:`label_tiled`)
+    :param pixels: if ``False``, only ``pairs`` and ``lengths`` are found"""
+    labels = numpy.asarray(labels)
+    height, width = labels.shape
+    n = max(n, 1)
+    strips = list(_strips(height, width, tile_size))
+    results = (mapper or itertools.imap)(_describe_strip, (
+        (labels[max(top-1, 0):bottom+1], min(top, 1), min(top, 1) + bottom - top, n, background, pixels)
+        for top, bottom in strips))
+    keys, lengths, area, border = [], [], [], []
+    for (top, _), (k, l, a, b) in itertools.izip(strips, results):
+        keys.append(k)
+        lengths.append(l)
+        area.append((top, a))
+        border.append((top, b))
+    keys = numpy.concatenate(keys or [numpy.zeros(0, dtype=numpy.int64)])
+    lengths = numpy.concatenate(lengths or [numpy.zeros(0, dtype=numpy.int64)])
+    if len(strips) > 1:
+        keys, inverse = numpy.unique(keys, return_inverse=True)
+        lengths = numpy.bincount(inverse, weights=lengths, minlength=keys.size).astype(numpy.int64)
+    result = {'pairs': numpy.column_stack((keys // n, keys % n)), 'lengths': lengths}
+    if pixels:
+        result['area'] = _concatenate_runs(area)
+        result['border'] = _concatenate_runs(border)
+    return result
+
+
+def boundaries(labels, tile_size=0, mapper=None):
+    """Return ``(pairs, lengths)`` tuple, where ``pairs`` is array of unique
+    pairs of adjacent labels (see :func:`adjacency`) and ``lengths`` is
+    array containing number of pairs of adjacent pixels having these
+    labels. See :func:`describe` for description of parameters."""
+    labels = numpy.asarray(labels)
+    n = int(labels.max()) + 1 if labels.size else 1
+    result = describe(labels, n, tile_size=tile_size, mapper=mapper, pixels=False)
+    return result['pairs'], result['lengths']
+
+
+def merge_small(labels, stats, threshold, tile_size=0, mapper=None):
+    """Merge components having less than ``threshold`` pixels into adjacent
+    component sharing longest boundary with it. Smallest components are
+    merged first and graph of components is updated after each merge, so
+    components grown by merging may stop being small. Label array is
+    relabelled in place, with new labels numbered in raster order of first
+    pixel. Returns ``(labels, stats, survivors)`` tuple, where ``stats`` are
+    statistics of new labels (see :func:`label`) and ``survivors[i]`` is
+    original label of component that absorbed others to create component
+    ``i``.
+    
+    :param labels: label array of shape ``(height, width)``
+    :param stats: statistics of labels (see :func:`label`)
+    :param threshold: minimal number of pixels of components left
+    :param tile_size: see :func:`describe`
+    :param mapper: see :func:`describe`"""
+    n = stats['first'].size
+    counts = stats['count'].copy()
+    # Mutable graph of components: graph[a][b] is length of boundary between
+    # components ``a`` and ``b``
+    graph = [{} for _ in xrange(n)]
+    pairs, lengths = boundaries(labels, tile_size=tile_size, mapper=mapper)
+    for (a, b), length in zip(pairs.tolist(), lengths.tolist()):
+        graph[a][b] = graph[b][a] = length
+    parent = numpy.arange(n)
+    heap = [(c, i) for i, c in enumerate(counts.tolist()) if c < threshold]
+    heapq.heapify(heap)
+    while heap:
+        count, a = heapq.heappop(heap)
+        if parent[a] != a or count != counts[a] or not graph[a]:
+            continue  # Already merged, grown or isolated
+        # Choose neighbour sharing longest boundary, then the largest one
+        b = max(graph[a], key=lambda x: (graph[a][x], counts[x], -x))
+        parent[a] = b
+        counts[b] += counts[a]
+        for c, length in graph[a].iteritems():
+            del graph[c][a]
+            if c != b:
+                graph[b][c] = graph[c][b] = graph[b].get(c, 0) + length
+        graph[a] = {}
+        if counts[b] < threshold:
+            heapq.heappush(heap, (counts[b], b))
+    # Resolve chains of merges and renumber components in raster order of
+    # first pixel
+    while True:
+        grandparent = parent[parent]
+        if (grandparent == parent).all():
+            break
+        parent = grandparent
+    roots = numpy.flatnonzero(parent == numpy.arange(n))
+    mapping, stats = _merge_statistics(stats, numpy.searchsorted(roots, parent), roots.size)
+    survivors = numpy.empty(roots.size, dtype=roots.dtype)
+    survivors[mapping[roots]] = roots
+    _relabel(labels, mapping, tile_size)
+    return labels, stats, survivors
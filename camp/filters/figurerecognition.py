@@ -17,6 +17,7 @@ class FigureRecognitor(BaseFilter):
             graphical = storage['TextRecognitor']['graphical']
         except KeyError, e:
             raise exc.CampFilterError("missing in 'storage': %s" % e)
+        labels = storage.get('Segmentizer', {}).get('labels')
 
         # Search for complex graphical figures using recognition plugins
         log.debug('searching for complex geometrical figures')
@@ -36,7 +37,7 @@ class FigureRecognitor(BaseFilter):
         for g in graphical:
             result = []
             for Genre, Recognitor in plugins:
-                value = Recognitor().test(g)
+                value = Recognitor(labels=labels).test(g)
                 if value:
                     result.append((value, Genre))
             if not result:
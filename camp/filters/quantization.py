@@ -1,28 +1,168 @@
 import os
 import logging
+import collections
+import itertools
+import numpy
 import camp.exc as exc
 
 from camp.config import Config
-from camp.core import Image, ImageStat
-from camp.core.colorspace import Convert, Range
+from camp.core import Image, ImageStat, pack, unpack
+from camp.core.colorspace import Convert, Range, LookupTable
 from camp.util import Random, dump
 from camp.filters import BaseFilter
-from camp.clusterer.metric import euclidean
-from camp.clusterer.kmeans import kmeans, Cluster
+from camp.clusterer.metric import euclidean, euclidean2, pairwise, one_to_many
+from camp.clusterer.kmeans import kmeans, kmeans_numpy, kmeans_hamerly,\
+    kmeans_minibatch, minibatches, Cluster
+from camp.clusterer.som import Som
 
 log = logging.getLogger(__name__)
 
+_kmeans_engines = {
+    'python': kmeans,
+    'numpy': kmeans_numpy,
+    'hamerly': kmeans_hamerly,
+    'minibatch': kmeans_minibatch}
+
+
+def _merge_buckets(colors, weights, size):
+    """Merge colors lying in same cube of ``size`` edge into their mean color
+    weighted by ``weights``. Returns ``(means, totals)`` tuple of arrays
+    containing mean color and total weight of each non-empty cube.
+    
+    >>> means, totals = _merge_buckets(
+    ...     numpy.array([(50, 10, 10), (50.5, 10.2, 10.1)]), numpy.array([3., 5.]), 2)
+    >>> [round(v, 1) for v in means[0]], totals.tolist()
+    ([50.3, 10.1, 10.1], [8.0])"""
+    cells = numpy.floor(colors / size).astype(numpy.int64)
+    _, buckets = numpy.unique(
+        cells.view([('', cells.dtype)] * cells.shape[1]), return_inverse=True)
+    totals = numpy.bincount(buckets, weights=weights)
+    means = numpy.empty((totals.size, colors.shape[1]))
+    for i in xrange(colors.shape[1]):
+        means[:, i] = numpy.bincount(buckets, weights=colors[:, i] * weights) / totals
+    return means, totals
+
 
 def _quantizer_dump(result, args=None, kwargs=None, dump_dir=None):
     result_file = os.path.join(dump_dir, 'after-quantization.png')
     result.save(result_file)
 
 
+class PaletteCache(object):
+    """Cache of cluster centroids found for previously quantized images.
+    Images are identified by a coarse fingerprint of their histogram, so
+    images created by the same generator share the entry. Least recently used
+    entries are removed once number of entries exceeds :attr:`size`."""
+    __instance = None
+
+    def __init__(self, size):
+        """Create new palette cache.
+        
+        :param size: maximal number of entries"""
+        self.size = size
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Return list of centroids stored for given key or ``None``."""
+        centroids = self._entries.pop(key, None)
+        if centroids is not None:
+            self._entries[key] = centroids
+        return centroids
+
+    def put(self, key, centroids):
+        """Store list of centroids for given key."""
+        self._entries.pop(key, None)
+        self._entries[key] = list(centroids)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def fingerprint(image, bits=3, threshold=0.5):
+        """Calculate fingerprint of given RGB image. This is a tuple of
+        indices of histogram bins containing at least ``threshold`` percent
+        of pixels, where histogram has ``2**bits`` bins per channel.
+        
+        :param image: RGB image"""
+        data = image.asarray() >> (8 - bits)
+        bins = numpy.zeros(data.shape[:2], dtype=numpy.intp)
+        for i in xrange(data.shape[2]):
+            bins <<= bits
+            bins |= data[..., i]
+        counts = numpy.bincount(bins.ravel(), minlength=1 << (bits * data.shape[2]))
+        return tuple(numpy.flatnonzero(counts / float(image.npixels) * 100 >= threshold).tolist())
+
+    @classmethod
+    def instance(cls, size):
+        """Get or create palette cache shared by all filters within a process.
+        
+        :param size: maximal number of entries"""
+        if cls.__instance is None:
+            cls.__instance = PaletteCache(size)
+        cls.__instance.size = size
+        return cls.__instance
+
+
 class Quantizer(BaseFilter):
+    """Filter performing color quantization process.
+    
+    :attr __f_colorspace__: colorspace in which colors are compared
+    :attr __f_metric__: name of function from :mod:`camp.clusterer.metric`
+    :attr __f_threshold1__: percentage of rarely used colors to be ignored
+        while choosing initial clusters
+    :attr __f_threshold2__: maximal percentage difference of colors seen as
+        single color
+    :attr __f_conversion_cache__: setting to ``True`` enables memoization of
+        RGB colors conversions, shared by all images processed
+    :attr __f_lut_file__: optional path to precomputed RGB conversion table
+        file (created if missing)
+    :attr __f_kmeans_engine__: name of k-means implementation to be used
+        (one of keys of ``_kmeans_engines`` dict)
+    :attr __f_weighted__: setting to ``True`` makes each color pull cluster
+        centroid proportionally to number of pixels having that color
+    :attr __f_tail_threshold__: percentage of pixels below which colors are
+        treated as long tail of rare colors
+    :attr __f_tail_mode__: what to do with long tail colors before k-means:
+        ``drop`` them or merge into ``bucket`` colors
+    :attr __f_tail_bucket_size__: size of bucket (in colorspace units)
+    :attr __f_minibatch_size__: number of colors in single batch of
+        mini-batch k-means
+    :attr __f_minibatch_max_batches__: maximal number of batches processed
+        by mini-batch k-means
+    :attr __f_passthrough_colors__: images having at most this number of
+        colors are not quantized
+    :attr __f_passthrough_palette__: setting to ``True`` disables
+        quantization of palette images which colors are well separated
+    :attr __f_palette_cache_size__: maximal number of entries in
+        :class:`PaletteCache` used to warm-start k-means (0 disables the
+        cache)
+    :attr __f_clusterer__: palette reduction method: ``kmeans`` (seeding
+        followed by k-means) or ``som`` (self-organizing map of fixed size)
+    :attr __f_som_rows__: number of SOM grid rows
+    :attr __f_som_cols__: number of SOM grid columns
+    :attr __f_som_epochs__: number of SOM training epochs"""
     __f_colorspace__ = 'LAB'
     __f_metric__ = 'euclidean'
     __f_threshold1__ = 0.1
     __f_threshold2__ = 5.0
+    __f_conversion_cache__ = True
+    __f_lut_file__ = None
+    __f_kmeans_engine__ = 'python'
+    __f_weighted__ = False
+    __f_tail_threshold__ = 0.0
+    __f_tail_mode__ = 'bucket'
+    __f_tail_bucket_size__ = 2.0
+    __f_minibatch_size__ = 1024
+    __f_minibatch_max_batches__ = 100
+    __f_passthrough_colors__ = 0
+    __f_passthrough_palette__ = False
+    __f_palette_cache_size__ = 0
+    __f_clusterer__ = 'kmeans'
+    __f_som_rows__ = 4
+    __f_som_cols__ = 4
+    __f_som_epochs__ = 10
 
     def __init__(self, next_filter=None):
         super(Quantizer, self).__init__(next_filter=next_filter)
@@ -36,39 +176,220 @@ class Quantizer(BaseFilter):
                     "metric: function '%s' does not exist in module "
                     "'camp.clusterer.metric'" % self.metric)
             self.metric = getattr(module, self.metric)
-        self.__c_encoder = getattr(Convert, "rgb2%s" % self.colorspace.lower())\
-            if self.colorspace != 'RGB' else lambda x: x
-        self.__c_decoder = getattr(Convert, "%s2rgb" % self.colorspace.lower())\
-            if self.colorspace != 'RGB' else lambda x: x
+        self.__c_encoder = getattr(Convert, "rgb2%s_array" % self.colorspace.lower())\
+            if self.colorspace != 'RGB' else numpy.asarray
+        self.__c_decoder = getattr(Convert, "%s2rgb_array" % self.colorspace.lower())\
+            if self.colorspace != 'RGB' else numpy.asarray
+        if self.colorspace != 'RGB':
+            lut_file = self.config('lut_file').value
+            if lut_file or self.config('conversion_cache').asbool():
+                self.__c_encoder = LookupTable.instance(
+                    self.__c_encoder, path=lut_file or None)
         self.threshold1 = self.config('threshold1').asfloat()
         self.threshold2 = self.config('threshold2').asfloat()
+        engine = self.config('kmeans_engine').value
+        if engine not in _kmeans_engines:
+            raise exc.CampFilterError(
+                "kmeans_engine: unknown engine '%s' (expecting one of: %s)" %
+                (engine, ', '.join(sorted(_kmeans_engines))))
+        self.kmeans = _kmeans_engines[engine]
+        self.weighted = self.config('weighted').asbool()
+        self.tail_threshold = self.config('tail_threshold').asfloat()
+        self.tail_mode = self.config('tail_mode').value
+        if self.tail_mode not in ('drop', 'bucket'):
+            raise exc.CampFilterError(
+                "tail_mode: expecting 'drop' or 'bucket', found '%s'" % self.tail_mode)
+        self.tail_bucket_size = self.config('tail_bucket_size').asfloat()
+        self.minibatch_size = self.config('minibatch_size').asint()
+        self.minibatch_max_batches = self.config('minibatch_max_batches').asint()
+        self.passthrough_colors = self.config('passthrough_colors').asint()
+        self.passthrough_palette = self.config('passthrough_palette').asbool()
+        self.clusterer = self.config('clusterer').value
+        if self.clusterer not in ('kmeans', 'som'):
+            raise exc.CampFilterError(
+                "clusterer: expecting 'kmeans' or 'som', found '%s'" % self.clusterer)
+        if self.weighted and self.clusterer == 'kmeans' and self.kmeans is kmeans:
+            raise exc.CampFilterError(
+                "weighted: not supported by '%s' k-means engine" % engine)
+        self.som_rows = self.config('som_rows').asint()
+        self.som_cols = self.config('som_cols').asint()
+        self.som_epochs = self.config('som_epochs').asint()
+        size = self.config('palette_cache_size').asint()
+        self.palette_cache = PaletteCache.instance(size) if size > 0 else None
+
+    def __encode(self, colors):
+        """Convert given sequence of RGB colors into colorspace used by this
+        filter. All colors are converted in single call of array encoder and
+        returned as list of tuples."""
+        if not colors:
+            return []
+        return [tuple(c) for c in self.__c_encoder(colors).tolist()]
+
+    def __get_colors(self, image):
+        """Return list of ``(amount, color)`` tuples (see
+        :meth:`camp.core.Image.colors`) with colors converted to colorspace
+        used by this filter."""
+        colors = list(image.colors())
+        encoded = self.__encode([c[1] for c in colors])
+        return [(colors[i][0], encoded[i]) for i in xrange(len(colors))]
+
+    def __reduce_tail(self, samples, weights, npixels):
+        """Drop or merge into buckets colors used by less than
+        :attr:`tail_threshold` percent of pixels. Bucket is a cube of
+        :attr:`tail_bucket_size` edge in colorspace used and all tail colors
+        inside it are replaced with their weighted mean color. Return
+        ``(samples, weights)`` tuple."""
+        tail = weights / float(npixels) * 100 < self.tail_threshold
+        if not tail.any():
+            return samples, weights
+        kept = [samples[i] for i in numpy.flatnonzero(~tail)]
+        if self.tail_mode == 'drop':
+            return kept, weights[~tail]
+        rare = numpy.array([samples[i] for i in numpy.flatnonzero(tail)], dtype=numpy.float64)
+        means, totals = _merge_buckets(rare, weights[tail], self.tail_bucket_size)
+        return (
+            kept + [tuple(m) for m in means.tolist()],
+            numpy.concatenate([weights[~tail], totals]))
 
     def __get_samples(self, image):
-        """Prepare and return list of samples for clusterer."""
-        return [s[1] for s in image.colors(encoder=self.__c_encoder)]
+        """Prepare and return ``(samples, weights)`` tuple for clusterer,
+        where ``samples`` is a list of colors and ``weights`` is an array
+        containing number of pixels of each color."""
+        colors = self.__get_colors(image)
+        samples = [c[1] for c in colors]
+        weights = numpy.array([c[0] for c in colors], dtype=numpy.float64)
+        if self.tail_threshold > 0:
+            ncolors = len(samples)
+            samples, weights = self.__reduce_tail(samples, weights, image.npixels)
+            log.debug(
+                'long tail reduction (%s): %d colors -> %d samples',
+                self.tail_mode, ncolors, len(samples))
+        return samples, weights
+
+    def __sample_batches(self, image):
+        """Return generator of random ``(samples, weights)`` batches of
+        image colors for mini-batch k-means (see
+        :func:`camp.clusterer.kmeans.minibatches`). Weights are given only if
+        :attr:`weighted` is set."""
+        samples, weights = self.__get_samples(image)
+        log.debug('number of colors before quantization: %d', len(samples))
+        return minibatches(
+            samples, self.minibatch_size, weights=weights if self.weighted else None)
+
+    def __nearest(self, colors, clusters):
+        """Return array of indices of clusters having centroid nearest to
+        each of given colors."""
+        centroids = numpy.array([c.centroid for c in clusters], dtype=numpy.float64)
+        result = numpy.empty(colors.shape[0], dtype=numpy.intp)
+        for start in xrange(0, colors.shape[0], 4096):
+            d = pairwise(self.metric, colors[start:start+4096], centroids)
+            result[start:start+4096] = d.argmin(axis=1)
+        return result
+
+    def __som(self, image):
+        """Reduce palette of given image using self-organizing map. Returns
+        list of clusters with centroids set to weights of SOM nodes."""
+        dim = image.nchannels
+        rng = getattr(Range, self.colorspace, None)
+        if not rng:
+            raise ValueError("%s: range for %s colorspace is not specified" % (Range, self.colorspace))
+        samples, weights = self.__get_samples(image)
+        log.debug('number of colors before quantization: %d', len(samples))
+        som = Som(
+            self.som_rows, self.som_cols, dim, metric=self.metric,
+            rnd=[Random(rmin=rng[0][i], rmax=rng[1][i], seed=i) for i in xrange(dim)])
+        som.train_batch(samples, self.som_epochs, weights=weights if self.weighted else None)
+        return [
+            Cluster(dim, metric=self.metric, centroid=tuple(n.weight))
+            for n in som.topology.nodes]
 
     def __create_result_image(self, image, clusters):
         """Create result image by changing color of each pixel in source image
-        to one of cluster centroid colors."""
-        encoder = self.__c_encoder
-        decoder = self.__c_decoder
-        res = Image.create(image.mode, image.width, image.height)
-        dpix = res.pixels
-        spix = image.pixels
-        cache = {}
-        for y in xrange(image.height):
-            for x in xrange(image.width):
-                s = spix[x, y]
-                if s not in cache:
-                    for c in clusters:
-                        if encoder(s) in c.samples:
-                            val = decoder(c.centroid)
-                            break
-                    cache[s] = val
-                    dpix[x, y] = val
-                else:
-                    dpix[x, y] = cache[s]
-        return res
+        to one of cluster centroid colors. Each source color is mapped to a
+        cluster once (using samples assigned to clusters or, if color was not
+        used as a sample, the nearest centroid) and then entire image is
+        rendered with a single array lookup."""
+        clusters = list(clusters)
+        # Find distinct colors and index of distinct color of each pixel
+        keys, inverse = numpy.unique(pack(image.asarray()), return_inverse=True)
+        encoded = numpy.asarray(self.__c_encoder(unpack(keys)), dtype=numpy.float64)
+        # Map each distinct color to a cluster
+        assigned = {}
+        for i, c in enumerate(clusters):
+            for sample in c.samples:
+                assigned.setdefault(sample, i)
+        mapping = numpy.array(
+            [assigned.get(tuple(e), -1) for e in encoded.tolist()], dtype=numpy.intp)
+        missing = mapping < 0
+        if missing.any():
+            mapping[missing] = self.__nearest(encoded[missing], clusters)
+        # Render result image using palette of cluster colors
+        palette = self.__c_decoder([c.centroid for c in clusters])
+        palette = numpy.clip(palette, 0, 255).astype(numpy.uint8)
+        return Image.fromarray(
+            palette[mapping][inverse].reshape(image.height, image.width, -1), image.mode)
+
+    def __separated(self, colors):
+        """Check if given RGB colors are well separated, i.e. if each two of
+        them differ more than :attr:`threshold2` allows for colors seen as
+        single color."""
+        max_difference = self.metric(*getattr(Range, self.colorspace))
+        colors = self.__encode(colors)
+        if len(colors) < 2:
+            return True
+        diff = pairwise(self.metric, colors, colors) / max_difference * 100
+        return not (diff[numpy.triu_indices(len(colors), 1)] <= self.threshold2).any()
+
+    def __fast_path(self, image):
+        """Check if quantization of given image can be skipped. Returns name
+        of the fast path taken (``palette`` or ``colors``) or ``None``."""
+        if image.mode == 'P' and self.passthrough_palette:
+            palette = image.palette
+            if self.__separated([palette[c[1]] for c in image.colors()]):
+                return 'palette'
+        # Palette images are checked as well, as their palette indices are
+        # counted (which never gives less colors than there are)
+        if self.passthrough_colors > 0:
+            if image.count_colors(limit=self.passthrough_colors) is not None:
+                return 'colors'
+
+    def __grid(self, colors, max_difference):
+        """Create grid index of given list of ``(amount, color)`` tuples. All
+        colors that are close enough to be seen as single color (see
+        :attr:`threshold2`) lie in same or adjacent grid cells. Returns
+        ``(cells, grid)`` tuple, where ``cells`` is list of grid cell of each
+        color and ``grid`` maps each cell to ascending list of indices of
+        colors inside it. Returns ``None`` if metric used does not allow to
+        create grid index."""
+        limit = self.threshold2 * max_difference / 100.0
+        if self.metric is euclidean:
+            radius = limit
+        elif self.metric is euclidean2:
+            radius = limit ** 0.5
+        else:
+            return
+        # Make cells slightly larger to be safe against rounding errors
+        radius = max(radius * (1.0 + 1e-9), 1e-6)
+        cells = numpy.floor(numpy.array([c[1] for c in colors]) / radius)
+        cells = [tuple(c) for c in cells.astype(numpy.int64).tolist()]
+        grid = {}
+        for i, c in enumerate(cells):
+            grid.setdefault(c, []).append(i)
+        return cells, grid
+
+    def __neighbours(self, index, i, ncolors):
+        """Return ascending sequence of indices of colors that can be close
+        to ``i``-th color. These are colors from grid cells adjacent to the
+        cell of ``i``-th color or all colors if there is no grid ``index``
+        (see :meth:`__grid`)."""
+        if not index:
+            return xrange(ncolors)
+        cells, grid = index
+        result = []
+        for offset in itertools.product((-1, 0, 1), repeat=len(cells[i])):
+            cell = tuple([a + b for a, b in zip(cells[i], offset)])
+            result.extend(grid.get(cell, []))
+        return sorted(result)
 
     def choose_clusters(self, image):
         """Heuristic used to choose cluster centers from training set.
@@ -86,16 +407,19 @@ class Quantizer(BaseFilter):
         max_difference = metric(*rng)
         # Sort colors by number of occurences in the image, descending and
         # ignore rare colors
-        colors = sorted([c for c in image.colors(encoder=self.__c_encoder) if c[0]/npixels*100 >= t1], key=lambda x: -x[0])
+        colors = sorted([c for c in self.__get_colors(image) if c[0]/npixels*100 >= t1], key=lambda x: -x[0])
+        # Index colors using grid, so only colors lying in adjacent grid
+        # cells are compared instead of comparing all pairs of colors
+        index = self.__grid(colors, max_difference) if colors else None
         for i in xrange(len(colors)):
             if not colors[i]:
                 continue  # Go to next color - already processed
             candidates = []
-            # Search for colors that are close to current color
-            for j in xrange(len(colors)):
-                if not colors[j]:
-                    continue  # Go to next color - already processed
-                diff = metric(colors[i][1], colors[j][1]) / max_difference * 100
+            # Search for colors that are close to current color. Skip colors
+            # already processed
+            neighbours = [j for j in self.__neighbours(index, i, len(colors)) if colors[j]]
+            diffs = one_to_many(metric, colors[i][1], [colors[j][1] for j in neighbours])
+            for j, diff in zip(neighbours, (diffs / max_difference * 100).tolist()):
                 if diff <= t2:
                     candidates.append(colors[j][1])
                     if j != i:
@@ -114,20 +438,59 @@ class Quantizer(BaseFilter):
     def process(self, image, storage=None):
         if not isinstance(image, Image):
             raise TypeError("image: expecting %s, found %s" % (Image, type(image)))
-        if image.mode.upper() != 'RGB':
-            raise ValueError("image: expecting RGB image, found %s" % image.mode.upper())
+        if image.mode.upper() not in ('RGB', 'P'):
+            raise ValueError("image: expecting RGB or P image, found %s" % image.mode.upper())
+        info = {'fast_path': None, 'kmeans': None, 'palette_cache': None}
+        if storage is not None:
+            storage[self.__class__.__name__] = info
+        # Skip quantization of images that already have few, distinct colors
+        info['fast_path'] = self.__fast_path(image)
+        if image.mode == 'P':
+            image = image.convert('RGB')
+        if info['fast_path']:
+            log.info('skipping quantization process (%s fast path)', info['fast_path'])
+            return image
         log.info('running quantization process')
         log.debug(
-            'quantization settings: colorspace=%s, metric=%s, t1=%s, t2=%s',
-            self.colorspace, self.metric.func_name, self.threshold1,
-            self.threshold2)
-        # Get samples from the source image
-        samples = self.__get_samples(image)
-        log.debug('number of colors before quantization: %d', len(samples))
-        # Choose initial clusters for the K-Means clusterer
-        initial_clusters = self.choose_clusters(image)
+            'quantization settings: colorspace=%s, metric=%s, t1=%s, t2=%s, '
+            'clusterer=%s, kmeans=%s', self.colorspace, self.metric.func_name,
+            self.threshold1, self.threshold2, self.clusterer,
+            self.kmeans.func_name)
+        if self.clusterer == 'som':
+            return self.__create_result_image(image, self.__som(image))
+        # Choose initial clusters for the K-Means clusterer. Use centroids
+        # found for similar image (if any) to start from nearly final state
+        if self.palette_cache is not None:
+            key = (self.colorspace, self.threshold1, self.threshold2,
+                PaletteCache.fingerprint(image))
+            cached = self.palette_cache.get(key)
+            info['palette_cache'] = 'hit' if cached else 'miss'
+        if self.palette_cache is not None and cached:
+            initial_clusters = [
+                Cluster(image.nchannels, metric=self.metric, centroid=c)
+                for c in cached]
+        else:
+            initial_clusters = self.choose_clusters(image)
         log.debug('number of colors after quantization: %d', len(initial_clusters))
         # Perform clustering and return clusters
-        clusters = kmeans(samples, initial_clusters)
+        stats = {}
+        if self.kmeans is kmeans_minibatch:
+            clusters = self.kmeans(
+                self.__sample_batches(image), initial_clusters,
+                max_batches=self.minibatch_max_batches, stats=stats)
+        else:
+            # Get samples from the source image
+            samples, weights = self.__get_samples(image)
+            log.debug('number of colors before quantization: %d', len(samples))
+            if self.weighted:
+                clusters = self.kmeans(samples, initial_clusters, weights=weights, stats=stats)
+            else:
+                clusters = self.kmeans(samples, initial_clusters, stats=stats)
+        log.debug(
+            'k-means finished after %(epochs)d epochs: %(distances)d '
+            'distances calculated, %(skipped)d skipped', stats)
+        info['kmeans'] = stats
+        if self.palette_cache is not None:
+            self.palette_cache.put(key, [c.centroid for c in clusters])
         # Create output image
         return self.__create_result_image(image, clusters)
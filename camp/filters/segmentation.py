@@ -1,8 +1,14 @@
 import weakref
 import logging
+import multiprocessing
+
+import numpy
+import camp.exc as exc
 
 from camp.core import Image
-from camp.core.containers import Segment
+from camp.core.containers import Segment, PixelSet, LabelPixelSet,\
+    SegmentGraph, NeighbourSet, LabelMap
+from camp.core import labeling
 from camp.filters import BaseFilter
 
 log = logging.getLogger(__name__)
@@ -39,8 +45,63 @@ def neighbourhood_with_bound_check(x, y, w, h):
 
 
 class Segmentizer(BaseFilter):
-    """Filter performing segmentation process."""
+    """Filter performing segmentation process. Besides list of segments,
+    :class:`LabelMap` assigning pixels to segments is saved in the storage
+    as ``labels``.
     
+    :attr __f_engine__: segmentation engine. ``unionfind`` labels pixels
+        using :func:`camp.core.labeling.label`, ``floodfill`` is reference
+        implementation working on sets of pixel coordinates
+    :attr __f_implicit_background__: if ``True``, area of the largest
+        segment (usually background of the image) is not stored as pixel
+        runs, but is backed by the label array (``unionfind`` engine only)
+    :attr __f_merge_below__: segments having less pixels are merged into
+        neighbouring segment sharing longest boundary with them (``0``
+        disables merging, ``unionfind`` engine only)
+    :attr __f_tile_size__: if greater than 0, image is processed in tiles
+        (and strips) of given size, so temporary arrays are bounded by tile
+        size (``unionfind`` engine only)
+    :attr __f_workers__: number of processes processing tiles in parallel
+        (requires :attr:`__f_tile_size__`)"""
+    __f_engine__ = 'unionfind'
+    __f_implicit_background__ = False
+    __f_merge_below__ = 0
+    __f_tile_size__ = 0
+    __f_workers__ = 1
+
+    def __init__(self, next_filter=None, pool=None):
+        """Create new segmentation filter.
+        
+        :param next_filter: see :class:`camp.filters.BaseFilter`
+        :param pool: optional :class:`multiprocessing.Pool` used to process
+            tiles. If not given, pool of :attr:`workers` processes is created
+            on first use (if more than one worker is configured) and reused
+            by all images processed by this filter"""
+        super(Segmentizer, self).__init__(next_filter=next_filter)
+        self.pool = pool
+        self.engine = self.config('engine').value
+        if self.engine not in ('unionfind', 'floodfill'):
+            raise exc.CampFilterError(
+                "engine: expecting 'unionfind' or 'floodfill', found '%s'" % self.engine)
+        self.implicit_background = self.config('implicit_background').asbool()
+        self.merge_below = self.config('merge_below').asint()
+        if self.merge_below > 0 and self.engine != 'unionfind':
+            raise exc.CampFilterError(
+                "merge_below: not supported by '%s' engine" % self.engine)
+        self.tile_size = self.config('tile_size').asint()
+        if self.tile_size < 0:
+            raise exc.CampFilterError(
+                "tile_size: expecting non-negative number, found %d" % self.tile_size)
+        if self.tile_size > 0 and self.engine != 'unionfind':
+            raise exc.CampFilterError(
+                "tile_size: not supported by '%s' engine" % self.engine)
+        self.workers = self.config('workers').asint()
+        if self.workers < 1:
+            raise exc.CampFilterError(
+                "workers: expecting positive number, found %d" % self.workers)
+        if self.workers > 1 and self.tile_size == 0:
+            raise exc.CampFilterError("workers: requires tile_size to be set")
+
     def __create_coordinate_sets(self, image):
         """Create map of ``color->pixel_coord_set`` for all pixels composing
         given image. Results of this method are later used by
@@ -82,6 +143,84 @@ class Segmentizer(BaseFilter):
         log.debug('done. Number of segments extracted: %d', len(segments))
         return segments
 
+    def __mapper(self):
+        """Return ``imap`` method of process pool used to process tiles or
+        ``None`` if tiles are processed by this process."""
+        if self.pool is None and self.workers > 1:
+            log.debug('starting pool of %d processes', self.workers)
+            self.pool = multiprocessing.Pool(self.workers)
+        return self.pool.imap if self.pool is not None else None
+
+    def __label_components(self, image):
+        """Label connected components of image pixels. Returns ``(labels,
+        stats)`` tuple, see :func:`camp.core.labeling.label`."""
+        if self.tile_size > 0:
+            log.debug('labeling image pixels in %dx%d tiles', self.tile_size, self.tile_size)
+            labels, stats = labeling.label_tiled(
+                image.asarray(), self.tile_size, mapper=self.__mapper())
+        else:
+            log.debug('labeling image pixels')
+            labels, stats = labeling.label(image.asarray())
+        log.debug('done. Number of segments extracted: %d', stats['first'].size)
+        return labels, stats
+
+    def __pixel_sets(self, runs, n):
+        """Return list of ``n`` pixel sets, where ``i``-th set contains pixels
+        of given runs (see :func:`camp.core.labeling.runs`) labelled with
+        ``i``."""
+        owners, ys, starts, ends = runs
+        bounds = numpy.searchsorted(owners, numpy.arange(n + 1)).tolist()
+        return [
+            PixelSet.fromruns(ys[a:b], starts[a:b], ends[a:b], normalized=True)
+            for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def __merge_small(self, labels, stats):
+        """Merge segments having less than :attr:`merge_below` pixels into
+        their neighbours. Returns ``(labels, stats, origins)`` tuple, where
+        ``origins`` is array of flat indices of pixels having original color
+        of each segment left."""
+        log.debug('merging segments smaller than %d pixels', self.merge_below)
+        first = stats['first']
+        labels, stats, survivors = labeling.merge_small(
+            labels, stats, self.merge_below, tile_size=self.tile_size, mapper=self.__mapper())
+        log.info(
+            'number of segments removed by merging: %d (%d left)',
+            first.size - survivors.size, survivors.size)
+        return labels, stats, first[survivors]
+
+    def __create_segments(self, labels, stats, image, origins=None):
+        """Create list of segments from label array created by
+        :meth:`__label_components`. Neighbours of segments are found by
+        comparing labels of adjacent pixels and are stored in single
+        :class:`SegmentGraph` shared by all segments. Gives same result as
+        :meth:`__get_segments` followed by :meth:`__get_neighbours`.
+        
+        :param origins: optional array of flat indices of pixels having
+            color of each segment (first pixel of segment by default)"""
+        log.debug('creating segments graph')
+        n = stats['first'].size
+        background = int(stats['count'].argmax()) if self.implicit_background and n else None
+        found = labeling.describe(
+            labels, n, tile_size=self.tile_size, background=background, mapper=self.__mapper())
+        graph = SegmentGraph.frompairs(n, found['pairs'])
+        areas = self.__pixel_sets(found['area'], n)
+        borders = self.__pixel_sets(found['border'], n)
+        del found
+        if background is not None:
+            areas[background] = LabelPixelSet(
+                labels, background, int(stats['count'][background]),
+                [int(stats[k][background]) for k in ('left', 'top', 'right', 'bottom')],
+                [int(stats[k][background]) for k in ('sumx', 'sumy')])
+            log.debug('background segment: %d (%d pixels)', background, len(areas[background]))
+        width, ptr = image.width, image.pixels
+        if origins is None:
+            origins = stats['first']
+        return [
+            Segment(
+                index=i, color=ptr[origin % width, origin // width],
+                area=areas[i], border=borders[i], neighbours=NeighbourSet(graph, i))
+            for i, origin in enumerate(origins.tolist())]
+
     def __label_pixels(self, segments, image):
         """Assign each pixel to its segment and return assignment map having
         same size as the image (map[x,y] stores index of segment from
@@ -122,15 +261,34 @@ class Segmentizer(BaseFilter):
 
     def process(self, image, storage=None):
         log.info('running segmentation process')
-        # Create set of pixel coordinates for each color giving map of (color,
-        # set_of_coords)
-        pixels = self.__create_coordinate_sets(image)
-        # Create list of segments by splitting all sets of pixel coordinates
-        # into disjoint subsets
-        segments = self.__get_segments(pixels)
-        # Label pixels in the image
-        pixel_map = self.__label_pixels(segments, image)
-        # Create connection matrix using previously labelled pixel map
-        segments = self.__get_neighbours(segments, pixel_map, image)
-        storage[self.__class__.__name__] = {'segments': segments}
+        if self.engine == 'unionfind':
+            # Label pixels in the image
+            labels, stats = self.__label_components(image)
+            origins, merged = None, 0
+            if self.merge_below > 0:
+                # Absorb small segments (f.e. anti-aliasing leftovers)
+                nsegments = stats['first'].size
+                labels, stats, origins = self.__merge_small(labels, stats)
+                merged = nsegments - origins.size
+            # Keep compact copy of labels, shared with segments backed by it
+            label_map = LabelMap(labels)
+            labels = label_map.array
+            # Create list of segments and segments graph comparing labels of
+            # adjacent pixels
+            segments = self.__create_segments(labels, stats, image, origins=origins)
+        else:
+            # Create set of pixel coordinates for each color giving map of
+            # (color, set_of_coords)
+            pixels = self.__create_coordinate_sets(image)
+            # Create list of segments by splitting all sets of pixel
+            # coordinates into disjoint subsets
+            segments = self.__get_segments(pixels)
+            # Label pixels in the image
+            pixel_map = self.__label_pixels(segments, image)
+            # Create connection matrix using previously labelled pixel map
+            segments = self.__get_neighbours(segments, pixel_map, image)
+            label_map = LabelMap(numpy.array(pixel_map).T)
+            merged = 0
+        storage[self.__class__.__name__] = {
+            'segments': segments, 'labels': label_map, 'merged': merged}
         return image
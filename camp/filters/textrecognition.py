@@ -1,5 +1,6 @@
 import os
 import logging
+import numpy
 import camp.exc as exc
 
 from camp.util import dump
@@ -36,9 +37,18 @@ def _text_recognition_dump(result, args=None, kwargs=None, dump_dir=None):
         os.path.join(dump_dir, 'difference.png'))
 
     # Dump remaining graphical segments
-    image3 = Image.create(image.mode, image.width, image.height, background=(255, 255, 255))
-    for g in graphical:
-        g.display(image3, color=g.color)
+    labels = kwargs['storage'].get('Segmentizer', {}).get('labels')
+    if labels is not None and image.mode == 'RGB':
+        # Paint all segments at once using label map as index to colors
+        colors = numpy.empty((labels.array.max() + 1, 3), dtype=numpy.uint8)
+        colors[:] = 255
+        for g in graphical:
+            colors[g.index] = g.color
+        image3 = Image.fromarray(colors[labels.array], mode='RGB')
+    else:
+        image3 = Image.create(image.mode, image.width, image.height, background=(255, 255, 255))
+        for g in graphical:
+            g.display(image3, color=g.color)
     image3.save(os.path.join(dump_dir, 'graphical.png'))
 
 
@@ -66,8 +76,11 @@ class TextRecognitor(BaseFilter):
     __f_max_vertical_height__ = 30
     __f_min_vfactor__ = 2.5
     
-    def extract_text(self, image, segments_):
-        """Find and return group of segments composing textual information."""
+    def extract_text(self, image, segments_, labels=None):
+        """Find and return group of segments composing textual information.
+        
+        :param labels: optional label map of the image used to render text
+            region candidates for OCR"""
         max_width = self.config('max_width').asint()
         max_height = self.config('max_height').asint()
         letter_delta = self.config('letter_delta').asint()
@@ -204,7 +217,8 @@ class TextRecognitor(BaseFilter):
         result = set()
         ocrs = []
         for OCRClass in OCRPluginBase.load_all():
-            ocrs.append(OCRClass(working_dir=os.path.join('data', 'ocr', OCRClass.__name__)))
+            ocrs.append(OCRClass(
+                working_dir=os.path.join('data', 'ocr', OCRClass.__name__), labels=labels))
         for c in candidates:
             horizontal = True
             for o in ocrs:
@@ -229,10 +243,11 @@ class TextRecognitor(BaseFilter):
             segments = storage['Segmentizer']['segments']
         except KeyError, e:
             raise exc.CampFilterError("missing in 'storage': %s" % e)
+        labels = storage['Segmentizer'].get('labels')
         
         # Text recognition process
         log.debug('searching for text regions')
-        text, text_candidates = self.extract_text(image, segments)
+        text, text_candidates = self.extract_text(image, segments, labels=labels)
         
         # Now split set of segment into two disjoined sets - one containing
         # textual segments, and one containing graphical segments
@@ -18,12 +18,15 @@ class OCRPluginBase(object):
     __ocr_priority__ = 0
     __ocr_enabled__ = True
 
-    def __init__(self, working_dir):
+    def __init__(self, working_dir, labels=None):
         """Create new instance of OCR recognitor.
         
-        :param working_dir: specifies working directory"""
+        :param working_dir: specifies working directory
+        :param labels: optional :class:`camp.core.containers.LabelMap` of
+            processed image, used to render segments passed to OCR tool"""
         super(OCRPluginBase, self).__init__()
         self.working_dir = working_dir
+        self.labels = labels
         if not os.path.isdir(self.working_dir):
             os.makedirs(self.working_dir)
     
@@ -1,5 +1,7 @@
 import os
 
+import numpy
+
 from camp.core.containers import FigureGenre
 
 
@@ -12,6 +14,14 @@ class RecognitorPluginBase(object):
         priority)"""
     __rp_priority__ = 0
 
+    def __init__(self, labels=None):
+        """Create new recognitor instance.
+        
+        :param labels: optional :class:`camp.core.containers.LabelMap` of
+            processed image. If given, feature points are searched in masks
+            cropped from it instead of in pixel sets of segments"""
+        self.labels = labels
+
     def extract_feature_points_by_mask(self, segment, mask, area=False):
         """Extract all feature points for given ``segment`` that match given
         9-element tuple ``mask``.
@@ -20,6 +30,8 @@ class RecognitorPluginBase(object):
         :param mask: 9-element tuple mask containing zeros and ones"""
         if len(mask) != 9:
             raise ValueError("mask: expecting 9 element sequence")
+        if self.labels is not None:
+            return self.__extract_feature_points_by_mask(segment, mask, area)
         def neighbourhood(x, y):
             yield mask[0], x-1, y-1  # NW
             yield mask[1], x, y-1    # N
@@ -39,6 +51,21 @@ class RecognitorPluginBase(object):
             else:
                 result.append((x, y))
         return result
+
+    def __extract_feature_points_by_mask(self, segment, mask, area):
+        """Same as :meth:`extract_feature_points_by_mask`, but tests all
+        pixels at once using segment mask cropped from :attr:`labels`."""
+        data = self.labels.crop(segment, border=1, edges=not area)
+        height, width = data.shape[0] - 2, data.shape[1] - 2
+        found = data[1:-1, 1:-1].copy()
+        for i, state in enumerate(mask):
+            if i == 4:
+                continue  # Center pixel
+            dy, dx = divmod(i, 3)
+            window = data[dy:dy+height, dx:dx+width]
+            found &= window if state else ~window
+        ys, xs = numpy.nonzero(found)
+        return zip((xs + segment.left).tolist(), (ys + segment.top).tolist())
     
     def extract_corners(self, segment):
         """Extracts corner feature points of given segment.